@@ -30,10 +30,15 @@ create table blogs (
 	`summary` varchar(50) not null,
 	`content` mediumtext not null,
 	`create_at` real not null,
+	`comment_count` bigint not null default 0,
 	key `idx_created_at` (`create_at`),
 	primary key (`id`)
 ) engine=innodb default charset=utf8;
 
+-- existing databases:
+-- alter table blogs add column `comment_count` bigint not null default 0;
+-- then run: python www/repair_counters.py
+
 create table comments (
 	`id` varchar(50) not null,
 	`blog_id` varchar(50) not null,
@@ -43,6 +48,7 @@ create table comments (
 	`content` mediumtext not null,
 	`create_at` real not null,
 	key `idx_created_at` (`create_at`),
+	key `idx_blog_id_create_at` (`blog_id`, `create_at`),
 	primary key (`id`)
 ) engine=innodb default charset=utf8;
 
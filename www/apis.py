@@ -10,9 +10,10 @@ __author__ = 'Jamin Qiang'
 JSON API definition.
 """
 
-import re, json, logging, functools
+import re, json, base64, logging, functools
 
 from transwarp.web import ctx
+from transwarp.db import Row
 
 class Page(object):
 	"""
@@ -44,26 +45,84 @@ class Page(object):
 		90
 		>>> p3.limit
 		10
+
+		With item_count=None no count is needed: the page asks for one more item
+		than page_size, and trim() drops it and sets has_next. item_count and
+		page_count stay None.
+
+		>>> p4 = Page(None, 3, 10)
+		>>> p4.offset
+		20
+		>>> p4.limit
+		11
+		>>> len(p4.trim(range(11)))
+		10
+		>>> p4.has_next
+		True
+		>>> p4.trim(range(5))
+		[0, 1, 2, 3, 4]
+		>>> p4.has_next
+		False
 		"""
 		self.item_count = item_count
 		self.page_size = page_size
-		self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
-		if (item_count == 0) or (page_index < 1) or (page_index > self.page_count):
-			self.offset = 0
-			self.limit = 0
-			self.page_index = 1
+		if item_count is None:
+			self.page_count = None
+			self.page_index = page_index if page_index > 0 else 1
+			self.offset = self.page_size * (self.page_index - 1)
+			self.limit = self.page_size + 1
+			self.has_next = False
 		else:
-			self.page_index = page_index
-			self.offset = self.page_size * (page_index - 1)
-			self.limit = self.page_size
-		self.has_next = self.page_index < self.page_count
+			self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
+			if (item_count == 0) or (page_index < 1) or (page_index > self.page_count):
+				self.offset = 0
+				self.limit = 0
+				self.page_index = 1
+			else:
+				self.page_index = page_index
+				self.offset = self.page_size * (page_index - 1)
+				self.limit = self.page_size
+			self.has_next = self.page_index < self.page_count
 		self.has_previous = self.page_index > 1
 
+	def trim(self, items):
+		"""
+		Return items of this page from the limit+1 items of a Page(None, ...).
+		"""
+		self.has_next = len(items) > self.page_size
+		return items[:self.page_size]
+
 	def __str__(self):
 		return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 
 	__repr__ = __str__
 
+def encode_cursor(*values):
+	"""
+	Encode the sort key of the last item of a page as an opaque cursor.
+
+	>>> decode_cursor(encode_cursor(1402909113.628, u'001'))
+	[1402909113.628, u'001']
+	"""
+	return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':'))).rstrip('=')
+
+def decode_cursor(cursor):
+	"""
+	Decode a cursor of encode_cursor(), raise APIValueError if it is invalid.
+
+	>>> decode_cursor('bad')
+	Traceback (most recent call last):
+	  ...
+	APIValueError: invalid cursor.
+	"""
+	try:
+		values = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+	except (TypeError, ValueError, UnicodeEncodeError):
+		values = None
+	if not isinstance(values, list):
+		raise APIValueError('cursor', 'invalid cursor.')
+	return values
+
 def _dump(obj):
 	if isinstance(obj, Page):
 		return {
@@ -73,6 +132,8 @@ def _dump(obj):
 			'has_next': obj.has_next,
 			'has_previous': obj.has_previous
 		}
+	if isinstance(obj, Row):
+		return obj.to_dict()
 	raise TypeError('%s is not JSON serializable' % obj)
 
 
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jamin Qiang'
+
+"""
+Benchmark of per-row memory and time: Dict rows vs compact db.Row.
+
+Usage: python benchmark_rows.py [rows]
+"""
+
+import gc, sys, time
+
+from transwarp.db import Dict, Row, _Columns
+from models import Blog
+
+_NAMES = ('id', 'user_id', 'user_name', 'user_image', 'name', 'summary', 'content', 'create_at')
+
+def _fetchall(n):
+	# simulate cursor.fetchall(): one tuple per row
+	return [('%050d' % i, '%050d' % 1, u'admin', u'about:blank', u'blog %d' % i, u'summary', u'content', 1402909113.628 + i) for i in xrange(n)]
+
+def _dict_rows(rows):
+	return [Dict(_NAMES, x) for x in rows]
+
+def _compact_rows(rows):
+	columns = _Columns(_NAMES)
+	return [Row(columns, x) for x in rows]
+
+def _measure(fn, rows):
+	start = time.time()
+	L = fn(rows)
+	return L, time.time() - start
+
+def _size_of_dicts(L):
+	return sum(sys.getsizeof(d) for d in L)
+
+def _size_of_rows(L):
+	# the value tuple is kept alive by Row, so it counts:
+	return sum(sys.getsizeof(r) + sys.getsizeof(r._values) for r in L)
+
+def main(n):
+	# keep the collector out of the timings:
+	gc.disable()
+	rows = _fetchall(n)
+	dicts, t_dict = _measure(_dict_rows, rows)
+	compact, t_row = _measure(_compact_rows, rows)
+	m_dict = _size_of_dicts(dicts)
+	m_row = _size_of_rows(compact)
+	print 'rows: %d' % n
+	print 'select (Dict): %8.1f ms, %8.1f KB' % (t_dict * 1000, m_dict / 1024.0)
+	print 'select (Row):  %8.1f ms, %8.1f KB' % (t_row * 1000, m_row / 1024.0)
+	print 'saved:         %8.1f ms, %8.1f KB' % ((t_dict - t_row) * 1000, (m_dict - m_row) / 1024.0)
+	start = time.time()
+	[Blog(**d) for d in dicts]
+	t_old = time.time() - start
+	start = time.time()
+	[Blog._from_row(r) for r in compact]
+	t_new = time.time() - start
+	print 'select + Blog(**Dict):       %8.1f ms' % ((t_dict + t_old) * 1000)
+	print 'select + Blog._from_row(Row): %7.1f ms' % ((t_row + t_new) * 1000)
+
+if __name__=='__main__':
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
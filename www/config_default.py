@@ -13,7 +13,23 @@ configs = {
 		'port': 3306,
 		'user': 'www-data',
 		'password': 'www-data',
-		'database': 'awesome'
+		'database': 'awesome',
+		# 预编译语句缓存，create_engine时在真实连接上检查，不可用则自动关闭：
+		'statement_cache_size': 64
+	},
+	'db_replicas': [
+		# dict(host='10.0.0.2', user='www-data', password='www-data', database='awesome', weight=1, max_lag=5)
+	],
+	'db_cache':{
+		'tables': ['blogs'],
+		'size': 1000,
+		'ttl': 10
+	},
+	# 'legacy': 50位字符串id，'int': 按时间递增的紧凑整数id（bigint），切换前先运行migrate_ids.py：
+	# 'int'必须设置node（0-31），每个写数据库的进程各不相同：
+	'ids':{
+		'format': 'legacy',
+		'node': None
 	},
 	'session':{
 		'secret': 'AwEsOmE'
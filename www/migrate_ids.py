@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jamin Qiang'
+
+"""
+Convert the legacy 50-char ids of users, blogs and comments, and the columns
+that refer to them, to compact time-ordered integers, see db.set_id_format().
+
+New ids keep the time of the old ones, so the order of rows is kept. Stop the
+application and back up the database first, then set configs.ids.format to
+'int' before starting it again. Signed-in users have to sign in again.
+
+Usage: python migrate_ids.py [batch_size]
+"""
+
+import re, sys, logging
+
+from transwarp import db
+from config import configs
+
+# table => columns that refer to it:
+_REFERENCES = (
+	('users', (('blogs', 'user_id'), ('comments', 'user_id'))),
+	('blogs', (('comments', 'blog_id'), )),
+	('comments', ()),
+)
+
+def _legacy_ids(table, batch_size):
+	# yield legacy ids in batches, oldest first; converted ids are not legacy:
+	last = ''
+	while True:
+		L = [r.id for r in db.select('select `id` from `%s` where length(`id`)=50 and `id`>? order by `id` limit ?' % table, last, batch_size)]
+		if not L:
+			return
+		last = L[-1]
+		yield L
+
+def _map_ids(table, batch_size):
+	# a generator per table keeps the new ids at the time of the old ones,
+	# one generator shared by all tables would push older rows forward:
+	generator = db._IdGenerator(node=0)
+	n = 0
+	for ids in _legacy_ids(table, batch_size):
+		# at most 250 rows an insert, SQLite takes 999 arguments by default:
+		for i in range(0, len(ids), 250):
+			args = []
+			for old in ids[i:i+250]:
+				# the first 15 digits of a legacy id are its time in milliseconds:
+				args.extend((old, str(generator.next(int(old[:15]) / 1000.0))))
+			db.update('insert into `_id_map` (`old`, `new`) values %s' % ','.join(['(?,?)'] * (len(args) / 2)), *args)
+		n = n + len(ids)
+	return n
+
+def _convert(table, col):
+	# one update per column, each row finds its new id by the primary key of
+	# _id_map, ids not in _id_map are left alone:
+	return db.update('update `%s` set `%s`=(select `new` from `_id_map` where `old`=`%s`.`%s`) where `%s` in (select `old` from `_id_map`)' % (table, col, table, col, col))
+
+def _rebuild_sqlite(table, cols):
+	# SQLite cannot change the type of a column, and ids in varchar columns
+	# read back as strings (TEXT affinity), so the table is created again with
+	# bigint columns and the rows are copied, which stores the ids as integers:
+	sql = db.select_one("select `sql` from `sqlite_master` where `type`='table' and `name`=?", table).sql
+	for col in cols:
+		sql = re.sub(r'((?<!\w)[`"]?%s[`"]?\s+)varchar\s*\(\s*50\s*\)' % col, r'\1bigint', sql, flags=re.IGNORECASE)
+	indexes = [r.sql for r in db.select("select `sql` from `sqlite_master` where `type`='index' and `tbl_name`=? and `sql` is not null", table)]
+	with db.transaction():
+		db.update('alter table `%s` rename to `_%s_old`' % (table, table))
+		db.update(sql)
+		db.update('insert into `%s` select * from `_%s_old`' % (table, table))
+		# the indexes of the old table go with it:
+		db.update('drop table `_%s_old`' % table)
+		for index in indexes:
+			db.update(index)
+
+def migrate(batch_size=500):
+	# create table commits on MySQL, so _id_map is created out of the transaction:
+	db.update('drop table if exists `_id_map`')
+	db.update('create table `_id_map` (`old` varchar(50) not null, `new` varchar(50) not null, primary key(`old`))')
+	try:
+		with db.transaction():
+			for table, references in _REFERENCES:
+				n = _map_ids(table, batch_size)
+				_convert(table, 'id')
+				for ref_table, col in references:
+					_convert(ref_table, col)
+				logging.info('%s: %d ids converted.' % (table, n))
+	finally:
+		db.update('drop table if exists `_id_map`')
+	# table => its id columns, the primary key and the columns that refer to others:
+	columns = dict([(table, ['id']) for table, references in _REFERENCES])
+	for table, references in _REFERENCES:
+		for ref_table, col in references:
+			columns[ref_table].append(col)
+	for table, references in _REFERENCES:
+		if db.engine.dialect.name=='mysql':
+			for col in columns[table]:
+				db.update('alter table `%s` modify `%s` bigint not null' % (table, col))
+		else:
+			_rebuild_sqlite(table, columns[table])
+
+if __name__=='__main__':
+	logging.basicConfig(level=logging.INFO)
+	db.create_engine(**configs.db)
+	migrate(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -7,44 +7,82 @@ __author__ = 'Jamin Qiang'
 Models for user, blog, commet.
 """
 
-import time, uuid
+import time
 
-from transwarp.db import next_id
-from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField
-
-def next_id():
-	return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+from transwarp import db
+from transwarp.orm import Model, IdField, StringField, BooleanField, FloatField, IntegerField, TextField, ForeignKey, HasMany
 
 class User(Model):
 	__table__ = 'users'
+	__cache__ = dict(ttl=60, size=1000)
 
-	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-	email = StringField(updatable=False, ddl='carchar(50)')
+	id = IdField(primary_key=True)
+	email = StringField(updatable=False, unique=True, ddl='varchar(50)')
 	password = StringField(ddl='varchar(50)')
 	admin = BooleanField()
 	name = StringField(ddl='varchar(50)')
 	image = StringField(ddl='varchar(500)')
-	create_at = FloatField(updatable=False, default=time.time)
+	create_at = FloatField(updatable=False, index=True, default=time.time)
 	# 这里的__table__，id等属性都是类的属性，不是实例的属性。从类级别上定义的属性用来描述对象和表的映射关系，而实例属性必须用__init__进行初始化。
 
 class Blog(Model):
 	__table__ = 'blogs'
+	__cache__ = dict(ttl=60, size=1000)
 
-	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-	user_id = StringField(updatable=False, ddl='varchar(50)')
+	id = IdField(primary_key=True)
+	user_id = IdField(updatable=False)
 	user_name = StringField(ddl='varchar(50)')
 	user_image = StringField(ddl='varchar(500)')
 	name = StringField(ddl='varchar(50)')
 	summary = StringField(ddl='varchar(200)')
-	content = TextField()
-	create_at = FloatField(updatable=False, default=time.time)
+	content = TextField(deferred=True)
+	create_at = FloatField(updatable=False, index=True, default=time.time)
+	# kept by Comment triggers, see Blog.increase() and repair_comment_counts():
+	comment_count = IntegerField(updatable=False)
+
+	user = ForeignKey('User', 'user_id')
+	comments = HasMany('Comment', 'blog_id', order_by='create_at desc')
+
+	@classmethod
+	def repair_comment_counts(cls, batch_size=500):
+		"""
+		Recompute comment_count of the blogs whose counter drifted, batch_size
+		blogs at a time. Return the number of repaired blogs.
+		"""
+		repaired = 0
+		q = cls.query.order_by('id').limit(batch_size)
+		last = None
+		while True:
+			blogs = (q if last is None else q.filter(id__gt=last)).values('id', 'comment_count')
+			if not blogs:
+				return repaired
+			last = blogs[-1].id
+			ids = [b.id for b in blogs]
+			counts = dict([(r.blog_id, r.c) for r in db.select('select `blog_id`, count(`id`) c from `comments` where `blog_id` in (%s) group by `blog_id`' % ','.join(['?'] * len(ids)), *ids)])
+			for b in blogs:
+				if b.comment_count != counts.get(b.id, 0):
+					# count again in the update, comments may have changed since:
+					db.update('update `blogs` set `comment_count`=(select count(`id`) from `comments` where `blog_id`=?) where `id`=?', b.id, b.id)
+					cls.uncache(b.id)
+					repaired = repaired + 1
 
 class Comment(Model):
 	__table__ = 'comments'
+	# comments of a blog page, newest first:
+	__indexes__ = [('blog_id', 'create_at')]
 
-	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-	blog_id = StringField(updatable=False, ddl='varchar(50)')
-	user_id = StringField(updatable=False, ddl='varchar(50)')
+	id = IdField(primary_key=True)
+	blog_id = IdField(updatable=False)
+	user_id = IdField(updatable=False)
 	user_name = StringField(ddl='varchar(50)')
 	content = TextField()
-	create_at = FloatField(updatable=False, default=time.time)
\ No newline at end of file
+	create_at = FloatField(updatable=False, index=True, default=time.time)
+
+	user = ForeignKey('User', 'user_id')
+	blog = ForeignKey('Blog', 'blog_id')
+
+	def post_insert(self):
+		Blog.increase(self.blog_id, comment_count=1)
+
+	def post_delete(self):
+		Blog.increase(self.blog_id, comment_count=-1)
\ No newline at end of file
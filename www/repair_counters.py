@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Jamin Qiang'
+
+"""
+Recompute the denormalized counters that drifted, e.g. after writes outside
+the ORM or a crash.
+
+Usage: python repair_counters.py [batch_size]
+"""
+
+import sys, logging
+
+from transwarp import db
+from config import configs
+from models import Blog
+
+def main(batch_size):
+	db.create_engine(**configs.db)
+	db.set_id_format(**configs.ids)
+	print 'blogs.comment_count repaired: %d' % Blog.repair_comment_counts(batch_size)
+
+if __name__=='__main__':
+	logging.basicConfig(level=logging.INFO)
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
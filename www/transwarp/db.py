@@ -7,7 +7,9 @@ __author__ = 'Jamin Qiang'
 Database operation module.
 '''
 
-import time,uuid,functools,threading,logging
+import os,re,sys,json,time,uuid,Queue,functools,itertools,threading,logging
+
+from collections import OrderedDict
 
 # Dict object:
 
@@ -61,9 +63,193 @@ class Dict(dict):
 	# 用于设置Dict实例的属性，内建函数
 		self[key] = value
 
+class _Columns(object):
+	"""
+	Column names of one select result, shared by all rows of the result.
+	"""
+	__slots__ = ('names', 'index')
+
+	def __init__(self, names):
+		self.names = tuple(names)
+		self.index = dict((n, i) for i, n in enumerate(self.names))
+
+class Row(object):
+	"""
+	Compact read-only row that stores values as a tuple and shares column
+	names with the other rows of the same result. Support access as x.y style
+	and as a read-only dict.
+
+	>>> cols = _Columns(('a', 'b'))
+	>>> r = Row(cols, (1, 'x'))
+	>>> r.a
+	1
+	>>> r['b']
+	'x'
+	>>> r.keys()
+	['a', 'b']
+	>>> r.to_dict()=={'a': 1, 'b': 'x'}
+	True
+	>>> dict(**r)=={'a': 1, 'b': 'x'}
+	True
+	>>> r.c
+	Traceback (most recent call last):
+		...
+	AttributeError: 'Row' object has no attribute 'c'
+	"""
+	__slots__ = ('_columns', '_values')
+
+	def __init__(self, columns, values):
+		self._columns = columns
+		self._values = values
+
+	def __getattr__(self, key):
+		try:
+			return self._values[self._columns.index[key]]
+		except KeyError:
+			raise AttributeError(r"'Row' object has no attribute '%s'" % key)
+
+	def __getitem__(self, key):
+		return self._values[self._columns.index[key]]
+
+	def get(self, key, default=None):
+		i = self._columns.index.get(key)
+		return default if i is None else self._values[i]
+
+	def __contains__(self, key):
+		return key in self._columns.index
+
+	def __len__(self):
+		return len(self._values)
+
+	def __iter__(self):
+		return iter(self._columns.names)
+
+	def __eq__(self, other):
+		if isinstance(other, Row):
+			other = other.to_dict()
+		return self.to_dict()==other
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def keys(self):
+		return list(self._columns.names)
+
+	def values(self):
+		return list(self._values)
+
+	def items(self):
+		return zip(self._columns.names, self._values)
+
+	def iterkeys(self):
+		return iter(self._columns.names)
+
+	def itervalues(self):
+		return iter(self._values)
+
+	def iteritems(self):
+		return itertools.izip(self._columns.names, self._values)
+
+	def to_dict(self):
+		"""
+		Return a mutable Dict copy of the row.
+		"""
+		return Dict(self._columns.names, self._values)
+
+	def __repr__(self):
+		return 'Row(%s)' % ', '.join(['%s=%r' % (k, v) for k, v in self.iteritems()])
+
+class _IdGenerator(object):
+	"""
+	Compact time-ordered integer ids that fit in 53 bits, so JavaScript
+	clients read them exactly: milliseconds since EPOCH (41 bits, good until
+	2083), node (5 bits) and sequence within the millisecond (7 bits). Ids
+	of one generator always increase, even if the clock goes back.
+
+	Processes writing to the same database must use distinct nodes, or two
+	of them can make the same id in the same millisecond. A forked process
+	does not inherit the generator: it needs a node of its own.
+
+	>>> g = _IdGenerator(node=3)
+	>>> a, b = g.next(1402909113.628), g.next(1402909113.628)
+	>>> b - a, a >> 12 == 1402909113628 - _IdGenerator.EPOCH, (a >> 7) & 31
+	(1, True, 3)
+	"""
+	# 2014-01-01 00:00:00 UTC in milliseconds:
+	EPOCH = 1388534400000
+	NODE_BITS = 5
+	SEQ_BITS = 7
+
+	def __init__(self, node):
+		if not isinstance(node, (int, long)) or not 0 <= node < (1 << self.NODE_BITS):
+			raise ValueError('Node must be an integer from 0 to %d: %r' % ((1 << self.NODE_BITS) - 1, node))
+		self.node = node
+		self._pid = os.getpid()
+		self._lock = threading.Lock()
+		self._last = 0
+		self._seq = 0
+
+	def next(self, t=None):
+		ms = int((time.time() if t is None else t) * 1000) - self.EPOCH
+		with self._lock:
+			if self._pid != os.getpid():
+				# the parent and its other children have the same node:
+				raise DBError('Id node %d is used by process %d, call set_id_format() with another node after fork.' % (self.node, self._pid))
+			if ms > self._last:
+				self._last = ms
+				self._seq = 0
+			else:
+				self._seq = self._seq + 1
+				if self._seq >> self.SEQ_BITS:
+					# sequence used up, borrow the next millisecond:
+					self._last = self._last + 1
+					self._seq = 0
+			return (self._last << (self.NODE_BITS + self.SEQ_BITS)) | (self.node << self.SEQ_BITS) | self._seq
+
+_id_format = 'legacy'
+_id_generator = None
+
+def set_id_format(format='legacy', node=None):
+	"""
+	Choose the ids of next_id(): 'legacy' for 50-char strings, or 'int' for
+	compact time-ordered integers stored as bigint, see _IdGenerator. The
+	IdField columns of models follow id_ddl().
+
+	'int' needs a node from 0 to 31, distinct for each process that writes to
+	the database, e.g. each worker of a web server.
+	"""
+	global _id_format, _id_generator
+	if not format in ('legacy', 'int'):
+		raise ValueError('Unknown id format: %s' % format)
+	if format=='int' and node is None:
+		raise ValueError('The int id format needs a node distinct for each process.')
+	_id_generator = _IdGenerator(node) if format=='int' else None
+	_id_format = format
+
+def id_ddl():
+	"""
+	Return the column type of ids made by next_id().
+	"""
+	return 'bigint' if _id_format=='int' else 'varchar(50)'
+
+def to_id(value):
+	"""
+	Return value as an id of the current format, e.g. an id from a URL or a
+	cookie: an int in 'int' format, or None if it is not a valid id.
+
+	>>> to_id('abc')
+	'abc'
+	"""
+	if _id_format=='int':
+		try:
+			return int(value)
+		except (TypeError, ValueError):
+			return None
+	return value
+
 def next_id(t=None):
 	"""
-	Return next id as 50-char string.
+	Return next id, a 50-char string or an integer, see set_id_format().
 
 	Args:
 		t: unix timestamp, default to None and using time.time().
@@ -71,18 +257,381 @@ def next_id(t=None):
 	# next_id用于mySQL，具体作用？
 	# uuid库，用于生成唯一的id，hex十六进制
 	# time.time()用于生成时间戳
+	if _id_format=='int':
+		return _id_generator.next(t)
 	if t is None:
 		t = time.time()
 	return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
 
-def _profiling(start,sql=''):
-	# _profiling函数用于mySQL
+_RE_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_RE_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_VALUES_LIST = re.compile(r'(\([?, ]*\))(?:\s*,\s*\([?, ]*\))+')
+_RE_IN_LIST = re.compile(r'\bin\s*\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+def fingerprint(sql):
+	"""
+	Return SQL with literals replaced by ? and lists of values collapsed, so
+	statements of the same shape have the same fingerprint.
+
+	>>> fingerprint("SELECT * FROM users  WHERE id='abc' and age>18 limit 10")
+	'select * from users where id=? and age>? limit ?'
+	>>> fingerprint('select * from blogs where id in (?,?,?)')
+	'select * from blogs where id in (?+)'
+	>>> fingerprint('insert into t (a,b) values (?,?),(?,?),(?,?)')
+	'insert into t (a,b) values (?,?),...'
+	"""
+	sql = _RE_STRING.sub('?', sql.replace('%s', '?'))
+	sql = _RE_NUMBER.sub('?', sql)
+	sql = ' '.join(sql.split()).lower()
+	sql = _RE_VALUES_LIST.sub(r'\1,...', sql)
+	return _RE_IN_LIST.sub('in (?+)', sql)
+
+class _StatementStats(object):
+	"""
+	Aggregated stats of one SQL fingerprint. Latency percentiles are computed
+	from the last SAMPLES executions.
+	"""
+	SAMPLES = 1000
+
+	def __init__(self, fingerprint):
+		self.fingerprint = fingerprint
+		self.count = 0
+		self.errors = 0
+		self.rows = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.samples = []
+		self._next = 0
+		self.plan = None
+		self.flags = []
+		self.explained_at = 0
+
+	def add(self, t, rows, error):
+		self.count = self.count + 1
+		self.total = self.total + t
+		if rows > 0:
+			self.rows = self.rows + rows
+		if error:
+			self.errors = self.errors + 1
+		if t > self.max:
+			self.max = t
+		if len(self.samples) < self.SAMPLES:
+			self.samples.append(t)
+		else:
+			self.samples[self._next] = t
+			self._next = (self._next + 1) % self.SAMPLES
+
+	def to_dict(self):
+		L = sorted(self.samples)
+		p = lambda q: L[min(len(L) - 1, int(len(L) * q))] if L else 0.0
+		return dict(fingerprint=self.fingerprint, count=self.count, errors=self.errors, rows=self.rows, total=self.total, max=self.max, avg=self.total / self.count if self.count else 0.0, p50=p(0.5), p95=p(0.95), p99=p(0.99), plan=self.plan, flags=self.flags, explained_at=self.explained_at)
+
+class _SqlStats(object):
+	"""
+	In-process registry of statement stats keyed by fingerprint.
+	"""
+	def __init__(self):
+		self.slow_threshold = 0.1
+		self._lock = threading.Lock()
+		self._statements = {}
+		self._fingerprints = {}
+
+	def fingerprint(self, sql):
+		fp = self._fingerprints.get(sql)
+		if fp is None:
+			fp = fingerprint(sql)
+			if len(self._fingerprints) < 10000:
+				self._fingerprints[sql] = fp
+		return fp
+
+	def record(self, sql, t, rows, error):
+		fp = self.fingerprint(sql)
+		with self._lock:
+			st = self._statements.get(fp)
+			if st is None:
+				st = self._statements[fp] = _StatementStats(fp)
+			st.add(t, rows, error)
+		return fp
+
+	def get(self, fp):
+		with self._lock:
+			st = self._statements.get(fp)
+			return st.to_dict() if st else None
+
+	def should_explain(self, fp, interval):
+		# claim the fingerprint so one slow statement is explained at most once per interval:
+		with self._lock:
+			st = self._statements.get(fp)
+			now = time.time()
+			if st is None or now - st.explained_at < interval:
+				return False
+			st.explained_at = now
+			return True
+
+	def set_plan(self, fp, plan, flags):
+		with self._lock:
+			st = self._statements.get(fp)
+			if st is not None:
+				st.plan = plan
+				st.flags = flags
+
+	def all(self):
+		with self._lock:
+			return [st.to_dict() for st in self._statements.itervalues()]
+
+	def reset(self):
+		with self._lock:
+			self._statements = {}
+
+_sql_stats = _SqlStats()
+
+_RE_EXPLAINABLE = re.compile(r'^\s*(?:select|update|delete)\b', re.I)
+
+def _plan_flags(plan):
+	"""
+	Return the warnings of an EXPLAIN result.
+
+	>>> _plan_flags([dict(table='comments', type='ALL', Extra='Using where; Using filesort'), dict(table='users', type='eq_ref', Extra=None)])
+	['full_scan:comments', 'filesort:comments']
+	>>> _plan_flags([dict(detail='SCAN comments'), dict(detail='USE TEMP B-TREE FOR ORDER BY')])
+	['full_scan:comments', 'filesort:comments']
+	"""
+	flags = []
+	table = None
+	for r in plan:
+		if 'detail' in r:
+			# sqlite: explain query plan
+			detail = r.get('detail') or ''
+			words = detail.split()
+			if words[:1]==['SCAN'] or words[:1]==['SEARCH']:
+				table = words[1] if len(words) > 1 else None
+			if words[:1]==['SCAN'] and 'INDEX' not in detail:
+				flags.append('full_scan:%s' % table)
+			if 'TEMP B-TREE FOR ORDER BY' in detail:
+				flags.append('filesort:%s' % table)
+			elif 'TEMP B-TREE' in detail:
+				flags.append('temporary:%s' % table)
+			continue
+		extra = r.get('Extra') or ''
+		if r.get('type')=='ALL':
+			flags.append('full_scan:%s' % r.get('table'))
+		if 'Using filesort' in extra:
+			flags.append('filesort:%s' % r.get('table'))
+		if 'Using temporary' in extra:
+			flags.append('temporary:%s' % r.get('table'))
+	return flags
+
+def _explain(sql, args):
+	# run on a connection of its own, never the one of the current context:
+	conn = engine.connect()
+	cursor = None
+	try:
+		cursor = conn.cursor()
+		cursor.execute('%s %s' % (engine.dialect.explain, sql), args)
+		columns = _Columns([x[0] for x in cursor.description])
+		return [Row(columns, x).to_dict() for x in cursor.fetchall()]
+	finally:
+		if cursor:
+			cursor.close()
+		engine.release(conn)
+
+class _Explainer(object):
+	"""
+	Background thread that runs EXPLAIN for slow statements and stores the
+	plan with the statement stats. Each fingerprint is explained at most once
+	every 'interval' seconds, and statements are dropped when the queue is full.
+	"""
+	def __init__(self, stats, interval=600, queue_size=100):
+		self.stats = stats
+		self.interval = interval
+		self.enabled = True
+		self._queue = Queue.Queue(queue_size)
+		self._lock = threading.Lock()
+		self._thread = None
+		self._pid = None
+
+	def submit(self, fp, sql, args):
+		if not self.enabled or engine is None or not _RE_EXPLAINABLE.match(sql):
+			return
+		if not self.stats.should_explain(fp, self.interval):
+			return
+		self._start()
+		try:
+			self._queue.put_nowait((fp, sql, args))
+		except Queue.Full:
+			pass
+
+	def _start(self):
+		with self._lock:
+			# the thread does not survive fork():
+			if self._pid != os.getpid() or not self._thread.is_alive():
+				self._pid = os.getpid()
+				self._queue = Queue.Queue(self._queue.maxsize)
+				self._thread = threading.Thread(target=self._run, name='sql-explain')
+				self._thread.daemon = True
+				self._thread.start()
+
+	def _run(self):
+		while True:
+			fp, sql, args = self._queue.get()
+			try:
+				plan = _explain(sql, args)
+				flags = _plan_flags(plan)
+				self.stats.set_plan(fp, plan, flags)
+				if flags:
+					logging.warning('[PROFILING] [DB] [EXPLAIN] %s: %s' % (fp, ', '.join(flags)))
+			except Exception, e:
+				logging.warning('explain failed: %s: %s' % (fp, e))
+
+_explainer = _Explainer(_sql_stats)
+
+def _redact(args):
+	return tuple('<%s>' % type(a).__name__ for a in args)
+
+def _profiling(start, sql='', args=(), rows=0, error=False):
+	# _profiling函数用于mySQL，记录每条SQL的执行时间，超过阈值时打印慢查询
 	# 函数前加下划线表示私有函数
 	t = time.time() - start
-	if t > 0.1:
-		logging.warning('[PROFILING] [DB] %s: %s' % (t,sql))
-	else:
-		logging.info('[PROFILING] [DB] %s: %s' % (t,sql))
+	fp = _sql_stats.record(sql, t, rows, error)
+	if t > _sql_stats.slow_threshold:
+		logging.warning('[PROFILING] [DB] [SLOW] %s: %s, ARGS: %s' % (t, sql, _redact(args)))
+		if not error:
+			_explainer.submit(fp, sql, args)
+
+def set_slow_query_threshold(seconds, explain=True, explain_interval=600):
+	"""
+	Log statements slower than 'seconds' as warnings, with args redacted.
+
+	If 'explain' is True, slow select/update/delete statements are explained
+	in the background, at most once every 'explain_interval' seconds per
+	fingerprint. The plan and its flags (full_scan, filesort, temporary) are
+	returned by sql_stats().
+	"""
+	_sql_stats.slow_threshold = seconds
+	_explainer.enabled = explain
+	_explainer.interval = explain_interval
+
+def sql_stats(order_by='total', limit=None):
+	"""
+	Return list of statement stats as dict, ordered by 'order_by' descending.
+	Each dict has fingerprint, count, errors, rows, total, max, avg, p50, p95
+	and p99; times are in seconds. Explained statements also have plan and
+	flags.
+	"""
+	L = sorted(_sql_stats.all(), key=lambda d: d[order_by], reverse=True)
+	return L[:limit] if limit else L
+
+def dump_sql_stats(order_by='total', limit=None):
+	"""
+	Return statement stats as JSON string.
+	"""
+	return json.dumps(sql_stats(order_by, limit))
+
+def reset_sql_stats():
+	_sql_stats.reset()
+
+def table_indexes(table):
+	"""
+	Return the indexes of table in the database as list of (name, columns, unique).
+	"""
+	return engine.dialect.indexes(table)
+
+_RE_ADVISE = re.compile(r'^(?:select .+? from|update|delete from) `?(\w+)`?(?: set .+?)?(?: where (.+?))?(?: group by .+?)?(?: order by (.+?))?(?: limit .+)?$')
+_RE_ADVISE_COND = re.compile(r'^\(*`?(\w+)`?\s*(=|<=>|in\b|<=|>=|<(?!>)|>|between\b)')
+_RE_ADVISE_ORDER = re.compile(r'^`?(\w+)`?(?: (?:asc|desc))?$')
+
+def _advised_columns(fp):
+	# return (table, columns, number of leading equality columns) of the index
+	# that serves the statement, or None:
+	if ' join ' in fp or '(select' in fp or ' union ' in fp:
+		return None
+	m = _RE_ADVISE.match(fp)
+	if m is None:
+		return None
+	table, where, order = m.groups()
+	eq = []
+	ranges = []
+	if where:
+		if ' or ' in where:
+			return None
+		for cond in where.split(' and '):
+			c = _RE_ADVISE_COND.match(cond.strip())
+			if c is None:
+				continue
+			col, op = c.groups()
+			if op in ('=', '<=>', 'in'):
+				eq.append(col)
+			else:
+				ranges.append(col)
+	cols = []
+	for col in eq:
+		if not col in cols:
+			cols.append(col)
+	n = len(cols)
+	if order:
+		for item in order.split(','):
+			o = _RE_ADVISE_ORDER.match(item.strip())
+			if o is None:
+				break
+			if not o.group(1) in cols:
+				cols.append(o.group(1))
+	elif ranges and not ranges[0] in cols:
+		cols.append(ranges[0])
+	return (table, tuple(cols), n) if cols else None
+
+def _with_primary_key(indexes):
+	# add the primary key columns to the end of the other indexes, as InnoDB does:
+	pk = ()
+	for name, cols, unique in indexes:
+		if name=='PRIMARY':
+			pk = cols
+	return [(name, cols + tuple([c for c in pk if not c in cols]), unique) for name, cols, unique in indexes]
+
+def _covered(cols, n, indexes):
+	# the equality columns may come in any order, the others may not:
+	for name, existing, unique in indexes:
+		if len(existing) >= len(cols) and set(existing[:n])==set(cols[:n]) and existing[n:len(cols)]==cols[n:]:
+			return True
+	return False
+
+def advise_indexes(limit=None):
+	"""
+	Suggest indexes for the statements in sql_stats() that no existing index
+	of the database serves: columns compared by = or in first, then the
+	order by columns or the first range column. Statements with or, joins or
+	subqueries are skipped. On MySQL an index also serves the primary key
+	columns after its own, as InnoDB stores them in every index. Return list of dict with table, columns, ddl,
+	fingerprints, count, total and flags, ordered by total time descending.
+	"""
+	advice = OrderedDict()
+	indexes = {}
+	for d in sql_stats():
+		r = _advised_columns(d['fingerprint'])
+		if r is None:
+			continue
+		table, cols, n = r
+		if not table in indexes:
+			try:
+				indexes[table] = table_indexes(table)
+				if engine.dialect.index_has_primary_key:
+					indexes[table] = _with_primary_key(indexes[table])
+			except StandardError, e:
+				logging.warning('[ADVISE] cannot read indexes of %s: %s' % (table, e))
+				indexes[table] = None
+		if indexes[table] is None:
+			continue
+		if _covered(cols, n, indexes[table]):
+			continue
+		a = advice.get((table, cols))
+		if a is None:
+			name = ('idx_%s_%s' % (table, '_'.join(cols)))[:64]
+			a = advice[(table, cols)] = dict(table=table, columns=cols, ddl='create index `%s` on `%s` (%s)' % (name, table, ','.join(['`%s`' % c for c in cols])), fingerprints=[], count=0, total=0.0, flags=[])
+		a['fingerprints'].append(d['fingerprint'])
+		a['count'] = a['count'] + d['count']
+		a['total'] = a['total'] + d['total']
+		a['flags'] = sorted(set(a['flags']) | set(d['flags'] or ()))
+	L = sorted(advice.values(), key=lambda a: a['total'], reverse=True)
+	return L[:limit] if limit else L
 
 class DBError(Exception):
 	pass
@@ -90,33 +639,241 @@ class DBError(Exception):
 class MultiColumnsError(DBError):
 	pass
 
+class PoolTimeoutError(DBError):
+	pass
+
+class _PooledConnection(object):
+	"""
+	A raw connection owned by the pool, with the bookkeeping needed for recycling.
+	"""
+	def __init__(self, connection):
+		self.connection = connection
+		self.pid = os.getpid()
+		self.created_at = time.time()
+		self.last_used = self.created_at
+		# (sql, cursor) of prepared statements of this connection by SQL, least
+		# recently used first:
+		self.statements = OrderedDict()
+
+	def cursor(self):
+		return self.connection.cursor()
+
+	def commit(self):
+		self.connection.commit()
+
+	def rollback(self):
+		self.connection.rollback()
+
+	def close(self):
+		statements = self.statements
+		self.statements = OrderedDict()
+		for sql, cursor in statements.itervalues():
+			try:
+				cursor.close()
+			except Exception:
+				pass
+		try:
+			self.connection.close()
+		except Exception, e:
+			logging.warning('close connection <%s> failed: %s' % (hex(id(self.connection)), e))
+
+class _ConnectionPool(object):
+	"""
+	Bounded pool of connections.
+
+	Args:
+		connect: function that opens a new raw connection.
+		ping: function that raises if a raw connection is dead, or None.
+		min_size: connections kept open even when idle.
+		max_size: connections open at the same time, borrowed or idle.
+		timeout: seconds to wait for a free connection before PoolTimeoutError.
+		recycle: max lifetime in seconds of a connection.
+		idle_timeout: seconds an idle connection is kept above min_size.
+		ping_interval: idle seconds after which a connection is pinged on checkout.
+	"""
+	def __init__(self, connect, ping=None, min_size=0, max_size=10, timeout=30, recycle=3600, idle_timeout=600, ping_interval=30):
+		if max_size < 1 or min_size > max_size:
+			raise ValueError('Invalid pool size: min=%s, max=%s' % (min_size, max_size))
+		self._connect = connect
+		self._ping = ping
+		self.min_size = min_size
+		self.max_size = max_size
+		self.timeout = timeout
+		self.recycle = recycle
+		self.idle_timeout = idle_timeout
+		self.ping_interval = ping_interval
+		self._reset()
+
+	def _reset(self):
+		# after fork() the idle connections share sockets with the parent,
+		# so they are dropped without being closed:
+		self._pid = os.getpid()
+		self._cond = threading.Condition(threading.Lock())
+		self._idle = []
+		self._size = 0
+
+	def _check_pid(self):
+		if self._pid != os.getpid():
+			logging.info('process forked, reset connection pool...')
+			self._reset()
+
+	def _is_expired(self, conn, now):
+		return self.recycle and now - conn.created_at > self.recycle
+
+	def _is_alive(self, conn, now):
+		if self._ping is None or now - conn.last_used < self.ping_interval:
+			return True
+		try:
+			self._ping(conn.connection)
+			return True
+		except Exception, e:
+			logging.warning('ping connection <%s> failed: %s' % (hex(id(conn.connection)), e))
+			return False
+
+	def _evict_idle(self, now):
+		# idle list is LIFO, so the longest idle connections are at the head:
+		evicted = []
+		while self._size > self.min_size and self._idle and now - self._idle[0].last_used > self.idle_timeout:
+			evicted.append(self._idle.pop(0))
+			self._size = self._size - 1
+		return evicted
+
+	def acquire(self):
+		"""
+		Borrow a connection, opening a new one if the pool is not full.
+		"""
+		deadline = time.time() + self.timeout
+		while True:
+			conn = None
+			with self._cond:
+				self._check_pid()
+				now = time.time()
+				discard = self._evict_idle(now)
+				while not self._idle and self._size >= self.max_size:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						raise PoolTimeoutError('No connection available in %s seconds.' % self.timeout)
+					self._cond.wait(remaining)
+				if self._idle:
+					conn = self._idle.pop()
+				else:
+					self._size = self._size + 1
+			for c in discard:
+				logging.info('evict idle connection <%s>...' % hex(id(c.connection)))
+				c.close()
+			if conn is None:
+				try:
+					conn = _PooledConnection(self._connect())
+				except:
+					self._discard(None)
+					raise
+				logging.info('open connection <%s>...' % hex(id(conn.connection)))
+				return conn
+			now = time.time()
+			if not self._is_expired(conn, now) and self._is_alive(conn, now):
+				return conn
+			self._discard(conn)
+
+	def release(self, conn):
+		"""
+		Return a borrowed connection to the pool.
+		"""
+		if conn.pid != os.getpid():
+			return
+		try:
+			# end the implicit transaction so the next borrower gets a fresh snapshot:
+			conn.rollback()
+		except Exception, e:
+			logging.warning('reset connection <%s> failed: %s' % (hex(id(conn.connection)), e))
+			self._discard(conn)
+			return
+		now = time.time()
+		if self._is_expired(conn, now):
+			self._discard(conn)
+			return
+		conn.last_used = now
+		with self._cond:
+			if self._pid != conn.pid:
+				return
+			self._idle.append(conn)
+			self._cond.notify()
+
+	def _discard(self, conn):
+		with self._cond:
+			if conn is None or self._pid == conn.pid:
+				self._size = self._size - 1
+				self._cond.notify()
+		if conn is not None:
+			logging.info('close connection <%s>...' % hex(id(conn.connection)))
+			conn.close()
+
+	def close(self):
+		"""
+		Close all idle connections. Borrowed connections are closed when released.
+		"""
+		with self._cond:
+			self._check_pid()
+			idle = self._idle
+			self._idle = []
+			self._size = self._size - len(idle)
+			self._cond.notify_all()
+		for conn in idle:
+			conn.close()
+
+	def status(self):
+		with self._cond:
+			return dict(size=self._size, idle=len(self._idle), max_size=self.max_size)
+
 class _LasyConnection(object):
 	# 延迟连接，用于减少长连接数，当有调用发起时，再创建长连接
 	# 打开游标时，才触发连接，并调用cursor/commit/rollback等函数
 
-	def __init__(self):
+	def __init__(self, engine=None):
+		# engine为None时使用全局的主库engine
+		self.engine = engine
 		self.connection = None
 
-	def cursor(self):
-	# 游标函数，如果打开游标时连接为空，建立连接为engine.connect()，返回游标值
+	def _borrow(self):
+		e = self.engine or engine
 		if self.connection is None:
-			connection = engine.connect()
-			logging.info('open connection <%s>...' % hex(id(connection)))
+			connection = e.connect()
+			logging.info('borrow connection <%s>...' % hex(id(connection.connection)))
 			self.connection = connection
-		return self.connection.cursor()
+		return e
+
+	def cursor(self, streaming=False):
+	# 游标函数，如果打开游标时连接为空，从连接池借出engine.connect()，返回游标值
+	# streaming为True时返回逐行读取结果的游标
+		e = self._borrow()
+		return e.dialect.cursor(self.connection.connection, streaming)
+
+	def statement(self, sql):
+		"""
+		Return (cursor, sql, cached) for sql, execute the returned sql. A cached
+		cursor is a prepared statement owned by the connection: read all its
+		rows and do not close it.
+		"""
+		e = self._borrow()
+		return e.statement(self.connection, sql)
+
+	def discard_statement(self, sql):
+		if self.connection:
+			(self.engine or engine).discard_statement(self.connection, sql)
 
 	def commit(self):
-		self.connection.commit()
+		if self.connection:
+			self.connection.commit()
 
 	def rollback(self):
-		self.connection.rollback()
+		if self.connection:
+			self.connection.rollback()
 
 	def cleanup(self):
 		if self.connection:
 			connection = self.connection
 			self.connection = None
-			logging.info('close connection <%s>...' % hex(id(connection)))
-			connection.close()
+			logging.info('return connection <%s>...' % hex(id(connection.connection)))
+			(self.engine or engine).release(connection)
 
 class _DbCtx(threading.local):
 	"""
@@ -126,7 +883,15 @@ class _DbCtx(threading.local):
 	# DbCtx：database context 数据库上下文？
 	def __init__(self):
 		self.connection = None
+		self.replica = None
 		self.transactions = 0
+		self.written_tables = set()
+		# functions to call when the outermost transaction ends:
+		self.after_transaction = []
+		self.has_written = False
+		self.maps = {}
+		# not reset by init(): primary() may be entered before the connection context:
+		self.primary_reads = 0
 
 	def is_init(self):
 		return not self.connection is None
@@ -134,11 +899,37 @@ class _DbCtx(threading.local):
 	def init(self):
 		logging.info('open lazy connection...')
 		self.connection = _LasyConnection()
+		self.replica = None
 		self.transactions = 0
+		self.written_tables = set()
+		self.after_transaction = []
+		self.has_written = False
+		self.maps = {}
 
 	def cleanup(self):
-		self.connection.cleanup()
-		self.connection = None
+		try:
+			if self.replica:
+				self.replica.cleanup()
+		finally:
+			self.replica = None
+			self.maps = {}
+			self.connection.cleanup()
+			self.connection = None
+
+	def read_connection(self):
+		"""
+		Return connection for select: a replica if there are healthy ones, except
+		inside a transaction, after a write in this context (read-your-writes)
+		or inside primary().
+		"""
+		if self.transactions or self.has_written or self.primary_reads or not _replicas.replicas:
+			return self.connection
+		if self.replica is None:
+			e = _replicas.choose()
+			if e is None:
+				return self.connection
+			self.replica = _LasyConnection(e)
+		return self.replica
 
 	def cursor(self):
 		"""
@@ -148,6 +939,40 @@ class _DbCtx(threading.local):
 
 # thread-local db context:
 _db_ctx = _DbCtx()
+
+def context_map(name):
+	"""
+	Return the dict 'name' that lives as long as the current connection
+	context, or None outside a connection context. All the dicts are cleared
+	when a transaction rolls back.
+	"""
+	if not _db_ctx.is_init():
+		return None
+	m = _db_ctx.maps.get(name)
+	if m is None:
+		m = _db_ctx.maps[name] = {}
+	return m
+
+def in_transaction():
+	"""
+	Return True if a transaction is open in the current thread.
+	"""
+	return _db_ctx.transactions > 0
+
+def after_transaction(func):
+	"""
+	Call func() when the current transaction commits or rolls back, or now
+	if no transaction is open. Caches of rows use it to drop entries that
+	readers may have filled with old rows before the commit.
+	"""
+	if _db_ctx.transactions > 0:
+		_db_ctx.after_transaction.append(func)
+	else:
+		func()
+
+def _clear_context_maps():
+	for m in _db_ctx.maps.itervalues():
+		m.clear()
 # threadlocal对象，持有的数据库连接对每个线程看到的是不一样的，任何一个线程都无法访问其他线程的数据
 
 # global engine object:
@@ -156,38 +981,358 @@ engine = None
 # 如果engine为空，通过create_engine函数，创建_Engine类的实例engine，并将参数params赋值至engine
 #
 
-class _Engine(object):
+def _gevent_patched():
+	# True if gevent has patched the socket module:
+	monkey = sys.modules.get('gevent.monkey')
+	return monkey is not None and monkey.is_module_patched('socket')
+
+class _MySQLDialect(object):
+	"""
+	SQL dialect of MySQL through mysql.connector.
+	"""
+	name = 'mysql'
+	explain = 'explain'
+	# InnoDB secondary indexes end with the primary key columns:
+	index_has_primary_key = True
+
+	def sql(self, sql):
+		# mysql.connector uses %s paramstyle:
+		return sql.replace('?', '%s')
+
+	def cursor(self, connection, streaming=False):
+		# connections are unbuffered, see create_engine(): the C extension
+		# ignores buffered=False on a buffered connection, so buffering is
+		# asked per cursor instead:
+		return connection.cursor() if streaming else connection.cursor(buffered=True)
+
+	def prepared_cursor(self, connection):
+		# mysql.connector has no buffered prepared cursor:
+		return connection.cursor(prepared=True, buffered=False)
+
+	def insert_prefix(self, on_duplicate):
+		return 'insert ignore into' if on_duplicate=='ignore' else 'insert into'
+
+	def upsert_suffix(self, key, cols):
+		return ' on duplicate key update %s' % ','.join(['`%s`=values(`%s`)' % (col, col) for col in cols])
+
+	def indexes(self, table):
+		# list of (name, columns, unique), the primary key included:
+		d = OrderedDict()
+		for r in select('show index from `%s`' % table):
+			d.setdefault(r.Key_name, (r.Key_name, [], not r.Non_unique))[1].append(r.Column_name)
+		return [(name, tuple(cols), unique) for name, cols, unique in d.itervalues()]
+
+	def create_engine(self, user, password, database, host, port, kw):
+		import mysql.connector
+		# 导入SQL驱动
+		pool_kw = dict((v, kw.pop(k)) for k, v in _POOL_ARGS.iteritems() if k in kw)
+		# statement_cache_size: 每个连接缓存的预编译语句数，0表示不使用预编译语句
+		statement_cache_size = kw.pop('statement_cache_size', 0)
+		params = dict(user=user, password=password, database=database, host=host, port=port)
+		# params 取值为create_engine函数的输入参数
+		defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
+		# defaults 包括四个参数，都赋予了默认值
+		for k, v in defaults.iteritems():
+			params[k] = kw.pop(k, v)
+		# 将defaults中的四个关键值取出，如果在kw中有赋值，按kw中的值赋予params，若kw中无赋值，按defaults的值赋予params
+		params.update(kw)
+		# 将kw中所有未插入params的关键值全部插入params
+		if _gevent_patched():
+			# only the pure Python driver waits on patched sockets, the C
+			# extension would block the whole event loop:
+			if params.get('use_pure') is False:
+				raise DBError('use_pure=False cannot run under gevent.')
+			params['use_pure'] = True
+		params['buffered'] = False
+		# 连接不缓冲结果，需要时由游标指定buffered=True
+		e = _Engine(lambda: mysql.connector.connect(**params), lambda conn: conn.ping(reconnect=False), self, statement_cache_size, **pool_kw)
+		# 以params中的关键值为参数建立连接
+		if statement_cache_size:
+			e.check_statements()
+		return e
+
+class _SQLiteDialect(_MySQLDialect):
 	"""
+	SQL dialect of SQLite through the sqlite3 module.
 
+	SQLite accepts the MySQL forms used by this module as they are: `quoted`
+	identifiers, 'limit ?,?' (offset, count) and the column types generated by
+	orm._gen_sql, and the sqlite3 module uses ? paramstyle. Upsert is done by
+	'insert ... on conflict(key) do update', which needs SQLite 3.24.
+	The sqlite3 module keeps its own per-connection statement cache, sized
+	by statement_cache_size.
 	"""
-	def __init__(self, connect):
-		self._connect = connect
+	name = 'sqlite'
+	explain = 'explain query plan'
+	# indexes end with the rowid, which is not the primary key column of tables
+	# created by orm._gen_sql:
+	index_has_primary_key = False
+
+	def sql(self, sql):
+		return sql
+
+	def cursor(self, connection, streaming=False):
+		# sqlite cursors always step through the result lazily:
+		return connection.cursor()
+
+	def prepared_cursor(self, connection):
+		return None
+
+	def insert_prefix(self, on_duplicate):
+		# not 'insert or replace', which deletes the row and loses the columns
+		# not inserted, see upsert_suffix():
+		return 'insert or ignore into' if on_duplicate=='ignore' else 'insert into'
+
+	def upsert_suffix(self, key, cols):
+		return ' on conflict(`%s`) do update set %s' % (key, ','.join(['`%s`=excluded.`%s`' % (col, col) for col in cols]))
+
+	def indexes(self, table):
+		L = []
+		for r in select('pragma index_list(`%s`)' % table):
+			cols = tuple([c.name for c in select('pragma index_info(`%s`)' % r.name)])
+			L.append((r.name, cols, bool(r.unique)))
+		return L
+
+	def create_engine(self, user, password, database, host, port, kw):
+		import sqlite3
+		pool_kw = dict((v, kw.pop(k)) for k, v in _POOL_ARGS.iteritems() if k in kw)
+		if 'statement_cache_size' in kw:
+			kw['cached_statements'] = kw.pop('statement_cache_size')
+		if database==':memory:':
+			# every connection has its own in-memory database, so keep exactly one forever:
+			pool_kw.update(min_size=1, max_size=1, recycle=0)
+		# pooled connections move between threads, one thread at a time:
+		kw['check_same_thread'] = False
+		return _Engine(lambda: sqlite3.connect(database, **kw), None, self, **pool_kw)
+
+_DIALECTS = dict(mysql=_MySQLDialect(), sqlite=_SQLiteDialect())
+
+class _Engine(object):
+	"""
+	Engine that lends pooled connections.
+	"""
+	def __init__(self, connect, ping=None, dialect=None, statement_cache_size=0, **pool_kw):
+		self.dialect = dialect or _DIALECTS['mysql']
+		self.statement_cache_size = statement_cache_size
+		self.statement_hits = 0
+		self.statement_misses = 0
+		self._lock = threading.Lock()
+		self._pool = _ConnectionPool(connect, ping, **pool_kw)
+
+	def statement(self, pooled, sql):
+		"""
+		Return (cursor, sql, cached): the prepared cursor of sql from the LRU of
+		the pooled connection, or a new plain cursor if prepared statements are
+		disabled or not supported.
+
+		mysql.connector prepares again unless execute() gets the very string
+		object it prepared ('is', not '=='), so the returned sql is the one
+		stored with the cursor and must be the one executed.
+		"""
+		if not self.statement_cache_size:
+			return self.dialect.cursor(pooled.connection), sql, False
+		cache = pooled.statements
+		entry = cache.pop(sql, None)
+		if entry is None:
+			cursor = self.dialect.prepared_cursor(pooled.connection)
+			if cursor is None:
+				return self.dialect.cursor(pooled.connection), sql, False
+			entry = (sql, cursor)
+			with self._lock:
+				self.statement_misses = self.statement_misses + 1
+			while len(cache) >= self.statement_cache_size:
+				sql_evicted, (_, cursor_evicted) = cache.popitem(last=False)
+				logging.info('evict prepared statement: %s' % sql_evicted)
+				cursor_evicted.close()
+		else:
+			with self._lock:
+				self.statement_hits = self.statement_hits + 1
+		cache[sql] = entry
+		return entry[1], entry[0], True
+
+	def discard_statement(self, pooled, sql):
+		entry = pooled.statements.pop(sql, None)
+		if entry is not None:
+			try:
+				entry[1].close()
+			except Exception:
+				pass
+
+	def check_statements(self):
+		"""
+		Open a prepared cursor on a real connection, and turn the statement
+		cache off if the driver or server cannot prepare statements.
+		"""
+		conn = self.connect()
+		try:
+			cursor = self.dialect.prepared_cursor(conn.connection)
+			if cursor is not None:
+				cursor.close()
+		except Exception, e:
+			logging.warning('prepared statements not available, statement cache disabled: %s' % e)
+			self.statement_cache_size = 0
+		finally:
+			self.release(conn)
 
 	def connect(self):
-		return self._connect()
+		return self._pool.acquire()
+
+	def release(self, connection):
+		self._pool.release(connection)
+
+	def dispose(self):
+		self._pool.close()
+
+	@property
+	def pool(self):
+		return self._pool
+
+_POOL_ARGS = dict(pool_min_size='min_size', pool_max_size='max_size', pool_timeout='timeout', pool_recycle='recycle', pool_idle_timeout='idle_timeout', pool_ping_interval='ping_interval')
+
+def statement_cache_stats():
+	"""
+	Return dict of size, hits and misses of the prepared statement caches of
+	the engine's connections.
+	"""
+	with engine._lock:
+		return dict(size=engine.statement_cache_size, hits=engine.statement_hits, misses=engine.statement_misses)
 
 def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
 	# 初始化数据库连接信息，初始化之后即可执行数据库操作。
-	import mysql.connector
-	# 导入SQL驱动
+	# pool_xxx 参数用于配置连接池，见 _POOL_ARGS
+	# dialect='sqlite' 时使用本地SQLite文件database，忽略user/password/host/port：
+	# create_engine(None, None, 'awesome.db', dialect='sqlite')
 	global engine
 	if engine is not None:
 		raise DBError('Engine is already initialized.')
-	params = dict(user=user, password=password, database=database, host=host, port=port)
-	# params 取值为create_engine函数的输入参数
-	defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
-	# defaults 包括四个参数，都赋予了默认值
-	for k, v in defaults.iteritems():
-		params[k] = kw.pop(k, v)
-	# 将defaults中的四个关键值取出，如果在kw中有赋值，按kw中的值赋予params，若kw中无赋值，按defaults的值赋予params
-	params.update(kw)
-	# 将kw中所有未插入params的关键值全部插入params
-	params['buffered'] = True
-	# params 中再插入一个关键值
-	engine = _Engine(lambda: mysql.connector.connect(**params))
-	# 以params中的关键值为参数建立连接
+	dialect = kw.pop('dialect', 'mysql')
+	if not dialect in _DIALECTS:
+		raise DBError('Unsupported dialect: %s' % dialect)
+	engine = _DIALECTS[dialect].create_engine(user, password, database, host, port, kw)
 	# test connection...
-	logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
+	logging.info('Init %s engine <%s> ok.' % (dialect, hex(id(engine))))
+
+class _Replica(object):
+	def __init__(self, engine, weight, max_lag):
+		self.engine = engine
+		self.weight = weight
+		self.max_lag = max_lag
+		self.current_weight = 0
+		self.healthy = True
+		self.lag = None
+
+class _ReplicaSet(object):
+	"""
+	Read replicas chosen by smooth weighted round-robin. Replication lag is
+	checked every 'check_interval' seconds by the thread that happens to choose
+	a replica, and replicas lagging more than their max_lag leave the rotation.
+	"""
+	def __init__(self, check_interval=5):
+		self.replicas = []
+		self.check_interval = check_interval
+		self._lock = threading.Lock()
+		self._checking = threading.Lock()
+		self._checked_at = 0
+
+	def add(self, replica):
+		with self._lock:
+			self.replicas = self.replicas + [replica]
+
+	def choose(self):
+		if time.time() - self._checked_at > self.check_interval and self._checking.acquire(False):
+			try:
+				self._checked_at = time.time()
+				self.check()
+			finally:
+				self._checking.release()
+		with self._lock:
+			total = 0
+			best = None
+			for r in self.replicas:
+				if not r.healthy:
+					continue
+				r.current_weight = r.current_weight + r.weight
+				total = total + r.weight
+				if best is None or r.current_weight > best.current_weight:
+					best = r
+			if best is None:
+				return None
+			best.current_weight = best.current_weight - total
+			return best.engine
+
+	def check(self):
+		for r in self.replicas:
+			if r.max_lag is None:
+				continue
+			try:
+				r.lag = _replica_lag(r.engine)
+			except Exception, e:
+				logging.warning('check replica <%s> failed: %s' % (hex(id(r.engine)), e))
+				r.lag = None
+			healthy = r.lag is not None and r.lag <= r.max_lag
+			if healthy != r.healthy:
+				logging.warning('replica <%s> %s rotation, lag: %s' % (hex(id(r.engine)), 'back in' if healthy else 'out of', r.lag))
+			r.healthy = healthy
+
+def _replica_lag(e):
+	# return seconds behind primary, or None if replication is not running:
+	conn = e.connect()
+	cursor = None
+	try:
+		cursor = conn.cursor()
+		cursor.execute('show slave status')
+		# read every row, the connection is unbuffered:
+		values = next(iter(cursor.fetchall()), None)
+		if not values:
+			return None
+		row = Row(_Columns([x[0] for x in cursor.description]), values)
+		return row.get('Seconds_Behind_Master')
+	finally:
+		if cursor:
+			cursor.close()
+		e.release(conn)
+
+# read replicas:
+_replicas = _ReplicaSet()
+
+def add_replica(user, password, database, host='127.0.0.1', port=3306, weight=1, max_lag=None, **kw):
+	"""
+	Register a read replica of the engine. select, select_one, select_int and
+	select_iter are sent to replicas by weighted round-robin, except inside a
+	transaction or after a write in the same connection context.
+
+	Args:
+		weight: share of reads relative to the other replicas.
+		max_lag: seconds of replication lag before the replica is taken out
+			of rotation, or None to skip lag checks.
+	"""
+	e = _DIALECTS['mysql'].create_engine(user, password, database, host, port, kw)
+	_replicas.add(_Replica(e, weight, max_lag))
+	logging.info('Add mysql replica <%s> %s:%s, weight=%s.' % (hex(id(e)), host, port, weight))
+
+class _PrimaryCtx(object):
+	"""
+	_PrimaryCtx object that sends the selects of the current thread to the
+	primary, can be nested.
+	"""
+	def __enter__(self):
+		_db_ctx.primary_reads = _db_ctx.primary_reads + 1
+		return self
+
+	def __exit__(self, exctype, excvalue, traceback):
+		_db_ctx.primary_reads = _db_ctx.primary_reads - 1
+
+def primary():
+	"""
+	Return _PrimaryCtx object to read from the primary in a 'with' statement.
+	Results that fill a shared cache are read from the primary: a lagging
+	replica could return a row older than the last invalidation, which would
+	then stay cached for the whole ttl.
+
+	with primary():
+		d = select_one('select * from blogs where id=?', blog_id)
+	"""
+	return _PrimaryCtx()
 
 class _ConnectionCtx(object):
 	# 自动获取和释放连接
@@ -261,10 +1406,21 @@ class _TranscationCtx(object):
 		_db_ctx.transactions = _db_ctx.transactions -1
 		try:
 			if _db_ctx.transactions==0:
-				if exctype is None:
-					self.commit()
-				else:
-					self.rollback()
+				try:
+					if exctype is None:
+						self.commit()
+					else:
+						self.rollback()
+				finally:
+					# readers may have cached old rows before the commit:
+					_invalidate_cache(_db_ctx.written_tables)
+					_db_ctx.written_tables = set()
+					callbacks, _db_ctx.after_transaction = _db_ctx.after_transaction, []
+					for func in callbacks:
+						try:
+							func()
+						except Exception, e:
+							logging.exception('after transaction: %s' % e)
 		finally:
 			if self.should_close_conn:
 				_db_ctx.cleanup()
@@ -277,6 +1433,7 @@ class _TranscationCtx(object):
 			logging.info('commit ok.')
 		except:
 			logging.warning('commit failed. try rollback...')
+			_clear_context_maps()
 			_db_ctx.connection.rollback()
 			logging.warning('rollback ok.')
 			raise
@@ -284,6 +1441,7 @@ class _TranscationCtx(object):
 	def rollback(self):
 		global _db_ctx
 		logging.warning('rollback transaction...')
+		_clear_context_maps()
 		_db_ctx.connection.rollback()
 		logging.info('rollback ok.')
 
@@ -337,38 +1495,255 @@ def with_transaction(func):
 	"""
 	@functools.wraps(func)
 	def _wrapper(*args, **kw):
-		_start = time.time()
 		with _TranscationCtx():
 			return func(*args, **kw)
-		_profiling(_start)
 	return _wrapper
 
+_RE_FROM = re.compile(r'\bfrom\s+(.+?)(?=\bwhere\b|\bgroup\b|\border\b|\blimit\b|\bhaving\b|\bunion\b|\bjoin\b|\bleft\b|\bright\b|\binner\b|\bcross\b|\bfor\b|\)|;|$)', re.I | re.S)
+_RE_JOIN = re.compile(r'\bjoin\s+`?(\w+)`?', re.I)
+_RE_WRITE = re.compile(r'^\s*(?:insert\s+(?:ignore\s+|or\s+\w+\s+)?into|replace\s+into|update|delete\s+from)\s+`?(\w+)`?', re.I)
+
+def _read_tables(sql):
+	"""
+	Return the set of tables read by select SQL.
+
+	>>> sorted(_read_tables('select * from `blogs` b, users where id=? order by x'))
+	['blogs', 'users']
+	>>> sorted(_read_tables('select count(id) from blogs join comments c on c.blog_id=blogs.id'))
+	['blogs', 'comments']
+	"""
+	tables = set(_RE_JOIN.findall(sql))
+	for clause in _RE_FROM.findall(sql):
+		for t in clause.split(','):
+			t = t.split()
+			if t:
+				tables.add(t[0].strip('`'))
+	return tables
+
+def _write_table(sql):
+	"""
+	Return the table changed by insert/update/delete SQL, or None if unknown.
+
+	>>> _write_table('insert into `blogs` (`id`) values (?)')
+	'blogs'
+	>>> _write_table('drop table blogs') is None
+	True
+	"""
+	m = _RE_WRITE.match(sql)
+	return m.group(1) if m else None
+
+class _QueryCache(object):
+	"""
+	LRU cache of select results keyed by normalized SQL and args.
+
+	Only queries that read tagged tables exclusively are cached. Each table
+	has a generation number which is increased by every write, and an entry is
+	only valid while the generations it was read at are current.
+	"""
+	def __init__(self, tables, size=1000, ttl=60):
+		self.tables = frozenset(tables)
+		self.size = size
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+		self._entries = OrderedDict()
+		self._generations = dict((t, 0) for t in self.tables)
+		self._sql_tables = {}
+
+	def key(self, sql, first, args):
+		"""
+		Return (key, generations) for cacheable SQL, or None.
+		"""
+		tables = self._sql_tables.get(sql)
+		if tables is None:
+			tables = _read_tables(sql)
+			tables = tuple(sorted(tables)) if tables and tables <= self.tables else ()
+			if len(self._sql_tables) < 10000:
+				self._sql_tables[sql] = tables
+		if not tables:
+			return None
+		key = (' '.join(sql.split()), first, args)
+		try:
+			hash(key)
+		except TypeError:
+			return None
+		with self._lock:
+			return key, tuple(self._generations[t] for t in tables)
+
+	def get(self, key, generations):
+		"""
+		Return (True, result) if found, or (False, None).
+		"""
+		with self._lock:
+			e = self._entries.pop(key, None)
+			if e is None or e[0] != generations or e[1] < time.time():
+				self.misses = self.misses + 1
+				return False, None
+			self._entries[key] = e
+			self.hits = self.hits + 1
+			return True, e[2]
+
+	def put(self, key, generations, result):
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (generations, time.time() + self.ttl, result)
+			while len(self._entries) > self.size:
+				self._entries.popitem(last=False)
+
+	def invalidate(self, tables=None):
+		with self._lock:
+			if tables is None:
+				tables = self.tables
+			for t in tables:
+				if t in self._generations:
+					self._generations[t] = self._generations[t] + 1
+
+	def stats(self):
+		with self._lock:
+			return dict(size=len(self._entries), hits=self.hits, misses=self.misses)
+
+# global query cache, disabled by default:
+_query_cache = None
+
+def enable_query_cache(tables, size=1000, ttl=60):
+	"""
+	Cache select results of queries that only read the given tables.
+
+	Writes through insert/update from this process invalidate the cached
+	results of the written table. Other processes are not notified, so 'ttl'
+	bounds how stale a result can be. Queries inside a transaction are not
+	cached.
+	"""
+	global _query_cache
+	_query_cache = _QueryCache(tables, size, ttl)
+	logging.info('Enable query cache for tables: %s' % ','.join(tables))
+
+def disable_query_cache():
+	global _query_cache
+	_query_cache = None
+
+def query_cache_stats():
+	"""
+	Return dict of size, hits and misses of the query cache, or None if disabled.
+	"""
+	cache = _query_cache
+	return cache.stats() if cache else None
+
+def _invalidate_cache(tables):
+	cache = _query_cache
+	if cache is not None and tables:
+		cache.invalidate(None if None in tables else tables)
+
 def _select(sql, first, *args):
 	' execute select SQL and return unique result or list results.'
 	global _db_ctx
+	cache = _query_cache
+	if cache is not None and _db_ctx.transactions==0:
+		k = cache.key(sql, first, args)
+		if k is not None:
+			found, result = cache.get(*k)
+			if found:
+				logging.info('SQL (cached): %s, ARGS: %s' % (sql, args))
+				# lists are copied so callers cannot change the cached one, rows are read-only:
+				return list(result) if isinstance(result, list) else result
+			# a cached result outlives this context, so it is never read from a replica:
+			with primary():
+				result = _do_select(sql, first, *args)
+			cache.put(k[0], k[1], list(result) if isinstance(result, list) else result)
+			return result
+	return _do_select(sql, first, *args)
+
+def _do_select(sql, first, *args):
 	cursor = None
-	sql = sql.replace('?', '%s')
+	sql = engine.dialect.sql(sql)
 	logging.info('SQL: %s, ARGS: %s' % (sql, args))
+	start = time.time()
+	rows = 0
+	error = True
+	conn = _db_ctx.read_connection()
+	cached = False
 	try:
-		cursor = _db_ctx.connection.cursor()
+		cursor, sql, cached = conn.statement(sql)
 		# 打开游标
 		cursor.execute(sql, args)
 		if cursor.description:
-			names = [x[0] for x in cursor.description]
+			columns = _Columns([x[0] for x in cursor.description])
 		if first:
-			values = cursor.fetchone()
+			# a cached statement is reused, so no row may be left unread:
+			values = cursor.fetchone() if not cached else next(iter(cursor.fetchall()), None)
+			error = False
 			if not values:
 				return None
-			return Dict(names, values)
-		return [Dict(names, x) for x in cursor.fetchall()]
+			rows = 1
+			return Row(columns, values)
+		L = [Row(columns, x) for x in cursor.fetchall()]
+		rows = len(L)
+		error = False
+		return L
 	finally:
-		if cursor:
+		if cursor and not cached:
 			cursor.close()
+		elif cached and error:
+			conn.discard_statement(sql)
+		_profiling(start, sql, args, rows, error)
+
+def select_iter(sql, *args, **kw):
+	"""
+	Execute select SQL and yield Row results one by one.
+
+	Rows are read through an unbuffered cursor in batches of 'batch' rows, so
+	memory stays flat for any size of result. The connection is busy until the
+	iteration ends: do not run other SQL in the same connection context before
+	the generator is exhausted or closed.
+
+	for d in select_iter('select * from comments where blog_id=?', blog_id, batch=500):
+		pass
+	"""
+	batch = kw.pop('batch', 1000)
+	if kw:
+		raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw))
+	global _db_ctx
+	sql = engine.dialect.sql(sql)
+	logging.info('SQL: %s, ARGS: %s' % (sql, args))
+	with _ConnectionCtx():
+		cursor = None
+		exhausted = False
+		# only time spent in the database counts, not in the caller's loop:
+		elapsed = 0.0
+		count = 0
+		error = True
+		try:
+			start = time.time()
+			cursor = _db_ctx.read_connection().cursor(streaming=True)
+			cursor.execute(sql, args)
+			columns = _Columns([x[0] for x in cursor.description])
+			while True:
+				rows = cursor.fetchmany(batch)
+				elapsed = elapsed + time.time() - start
+				if not rows:
+					exhausted = True
+					error = False
+					break
+				count = count + len(rows)
+				for x in rows:
+					yield Row(columns, x)
+				start = time.time()
+		finally:
+			if cursor:
+				# drain unread rows so the connection can be reused:
+				while not exhausted:
+					try:
+						exhausted = not cursor.fetchmany(batch)
+					except Exception:
+						break
+				cursor.close()
+			_profiling(time.time() - elapsed, sql, args, count, error)
 
 @with_connection
 def select_one(sql, *args):
 	"""
-	Execute select SQL and expected one result.
+	Execute select SQL and expected one result as Row.
 	If no result found, return None.
 	If multiple results found, the first one returned.
 	"""
@@ -387,7 +1762,7 @@ def select_int(sql, *args):
 @with_connection
 def select(sql, *args):
 	"""
-	Execute select SQL and return list or empty list if no result.
+	Execute select SQL and return list of Row or empty list if no result.
 	"""
 	return _select(sql, False, *args)
 
@@ -396,20 +1771,34 @@ def _update(sql, *args):
 	# 函数名前加单个下划线_表示此函数为私有函数，但不是真正的私有访问权限
 	global _db_ctx
 	cursor = None
-	sql = sql.replace('?', '%s')
+	sql = engine.dialect.sql(sql)
 	logging.info('SQL: %s, ARGS:%s' % (sql, args))
+	start = time.time()
+	r = 0
+	error = True
+	cached = False
 	try:
-		cursor = _db_ctx.connection.cursor()
+		cursor, sql, cached = _db_ctx.connection.statement(sql)
 		cursor.execute(sql, args)
 		r = cursor.rowcount
+		error = False
+		_db_ctx.has_written = True
+		table = _write_table(sql)
+		_invalidate_cache((table,))
 		if _db_ctx.transactions==0:
 			# no transaction enviroment:
 			logging.info('auto commit')
 			_db_ctx.connection.commit()
+			_invalidate_cache((table,))
+		else:
+			_db_ctx.written_tables.add(table)
 		return r
 	finally:
-		if cursor:
+		if cursor and not cached:
 			cursor.close()
+		elif cached and error:
+			_db_ctx.connection.discard_statement(sql)
+		_profiling(start, sql, args, r, error)
 
 def insert(table, **kw):
 	"""
@@ -419,6 +1808,49 @@ def insert(table, **kw):
 	sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
 	return _update(sql, *args)
 
+def insert_many(table, rows, chunk_size=500, on_duplicate=None, key='id', update=None):
+	"""
+	Execute multi-row insert SQL in chunks of 'chunk_size' rows and return the
+	number of affected rows. All rows must have the same columns.
+
+	on_duplicate: None to fail on duplicate keys, 'ignore' to skip them, or
+	'update' to overwrite the columns in 'update' of the existing row, all
+	inserted columns but the primary key 'key' by default.
+
+	>>> insert_many('user', [dict(id=1100, name='A'), dict(id=1101, name='B')])
+	2
+	"""
+	if on_duplicate not in (None, 'ignore', 'update'):
+		raise ValueError('Invalid on_duplicate: %s' % on_duplicate)
+	rows = list(rows)
+	if not rows:
+		return 0
+	cols = sorted(rows[0].iterkeys())
+	col_set = set(cols)
+	for r in rows:
+		if len(r)!=len(cols) or not col_set.issuperset(r):
+			raise DBError('All rows must have the same columns: %s' % ','.join(cols))
+	placeholder = '(%s)' % ','.join(['?' for col in cols])
+	tail = ''
+	if on_duplicate=='update':
+		update = [col for col in cols if col!=key] if update is None else list(update)
+		if update:
+			tail = engine.dialect.upsert_suffix(key, update)
+		else:
+			# nothing to overwrite:
+			on_duplicate = 'ignore'
+	prefix = engine.dialect.insert_prefix(on_duplicate)
+	head = '%s `%s` (%s) values ' % (prefix, table, ','.join(['`%s`' % col for col in cols]))
+	n = 0
+	with transaction():
+		for i in range(0, len(rows), chunk_size):
+			chunk = rows[i:i+chunk_size]
+			args = []
+			for r in chunk:
+				args.extend([r[col] for col in cols])
+			n = n + _update(head + ','.join([placeholder] * len(chunk)) + tail, *args)
+	return n
+
 def update(sql, *args):
 	# 直接调用_update函数
 	"""
@@ -11,7 +11,9 @@ __author__ = 'Jamin Qiang'
 Database operation module. This module is independent with web module.
 """
 
-import time, logging
+import time, logging, threading
+
+from collections import OrderedDict
 
 import db
 
@@ -27,6 +29,11 @@ class Field(object):
 		self.updatable = kw.get('updatable', True)
 		self.insertable = kw.get('insertable', True)
 		self.ddl = kw.get('ddl', '')
+		# deferred fields are left out of find_xxx() results and loaded on first access:
+		self.deferred = kw.get('deferred', False)
+		# single column index, see also Model.__indexes__:
+		self.index = kw.get('index', False)
+		self.unique = kw.get('unique', False)
 		self._order = Field._count
 		Field._count = Field._count + 1
 
@@ -35,11 +42,17 @@ class Field(object):
 		d = self._default
 		return d() if callable(d) else d
 
+	def convert(self, value):
+		# value of this field from a string, e.g. a primary key from a URL:
+		return value
+
 	def __str__(self):
 		s = ['<%s:%s,%s,default(%s),' % (self.__class__.__name__, self.name, self.ddl, self._default)]
 		self.nullable and s.append('N')
 		self.updatable and s.append('U')
 		self.insertable and s.append('I')
+		self.deferred and s.append('D')
+		self.unique and s.append('Q') or self.index and s.append('X')
 		s.append('>')
 		return ''.join(s)
 
@@ -65,6 +78,28 @@ class IntegerField(Field):
 			kw['ddl'] = 'bigint'
 		super(IntegerField, self).__init__(**kw)
 
+class IdField(Field):
+	"""
+	Id made by db.next_id(), as primary key or reference. The column type
+	follows db.set_id_format() unless ddl is given.
+	"""
+
+	def __init__(self, **kw):
+		if not 'default' in kw:
+			kw['default'] = db.next_id if kw.get('primary_key') else None
+		super(IdField, self).__init__(**kw)
+
+	@property
+	def ddl(self):
+		return self._ddl or db.id_ddl()
+
+	@ddl.setter
+	def ddl(self, value):
+		self._ddl = value
+
+	def convert(self, value):
+		return db.to_id(value)
+
 class FloatField(Field):
 	"""
 	"""
@@ -106,7 +141,7 @@ class BlobField(Field):
 		if not 'default' in kw:
 			kw['default'] = ''
 		if not 'ddl' in kw:
-			kw['ddl'] = 'bolb'
+			kw['ddl'] = 'blob'
 		super(BlobField, self).__init__(**kw)
 
 class VersionField(Field):
@@ -116,9 +151,204 @@ class VersionField(Field):
 	def __init__(self, name=None):
 		super(VersionField, self).__init__(name=name, default=0, ddl='bigint')
 
-_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
+class _Relation(object):
+	"""
+	Base class of relations. A relation is not a column, it loads related
+	objects for a whole list of objects with one 'in (...)' query, see
+	Model.prefetch().
+	"""
+
+	def __init__(self, model, field, order_by=None):
+		# model is a Model subclass or its class name:
+		self._model = model
+		self.field = field
+		self.order_by = order_by
+		self.name = None
+
+	@property
+	def model(self):
+		m = self._model
+		if isinstance(m, basestring):
+			m = self._model = ModelMetaclass.subclasses[m]
+		return m
+
+	def load(self, objs):
+		raise NotImplementedError()
+
+class ForeignKey(_Relation):
+	"""
+	Many-to-one relation by a field of this model, loads one object or None:
+
+	class Comment(Model):
+		user_id = StringField(updatable=False, ddl='varchar(50)')
+		user = ForeignKey('User', 'user_id')
+	"""
+
+	def load(self, objs):
+		# Model.get() hides dict.get():
+		found = self.model.get_many([dict.get(obj, self.field) for obj in objs if dict.get(obj, self.field)])
+		for obj in objs:
+			obj._set_related(self.name, found.get(dict.get(obj, self.field)))
+
+class HasMany(_Relation):
+	"""
+	One-to-many relation by a field of the related model, loads a list:
+
+	class Blog(Model):
+		comments = HasMany('Comment', 'blog_id', order_by='create_at desc')
+	"""
+
+	def load(self, objs):
+		if not objs:
+			return
+		key = objs[0].__primary_key__.name
+		groups = dict([(obj[key], []) for obj in objs])
+		for obj in self.model._load_in(self.field, groups.keys(), self.order_by):
+			groups[obj[self.field]].append(obj)
+		for obj in objs:
+			obj._set_related(self.name, groups[obj[key]])
+
+# post_xxx triggers run in the same transaction as the statement:
+_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete', 'post_insert', 'post_update', 'post_delete'])
+
+# counts of count_all(max_age=...) by table, as [count, time]. ORM inserts
+# and deletes keep them up to date in between:
+_counts = {}
+
+def _count_changed(cls, n):
+	c = _counts.get(cls.__table__)
+	if c is not None:
+		c[0] = c[0] + n
+
+# max number of values in one 'in (...)' query:
+_IN_CHUNK_SIZE = 500
+
+def _identity_map():
+	# identity map of the current db connection context, e.g. one web request:
+	return db.context_map('orm.identity')
+
+class LRUCache(object):
+	"""
+	In-process LRU backend of the model cache. Any object with the same
+	get(), get_many(), set() and delete() methods can be used instead, e.g. a
+	client of a shared store, see set_cache_backend(). Keys are strings and
+	values are dicts of column values.
+	"""
+	def __init__(self, size=1000):
+		self.size = size
+		self._lock = threading.Lock()
+		self._entries = OrderedDict()
+
+	def get(self, key):
+		with self._lock:
+			e = self._entries.pop(key, None)
+			if e is None or e[0] < time.time():
+				return None
+			self._entries[key] = e
+			return e[1]
+
+	def get_many(self, keys):
+		d = {}
+		for key in keys:
+			value = self.get(key)
+			if value is not None:
+				d[key] = value
+		return d
+
+	def set(self, key, value, ttl):
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (time.time() + ttl, value)
+			while len(self._entries) > self.size:
+				self._entries.popitem(last=False)
+
+	def delete(self, key):
+		with self._lock:
+			self._entries.pop(key, None)
 
-def _gen_sql(table_name, mappings):
+class _ModelCache(object):
+	"""
+	Second level cache of one model: rows by primary key, shared by all
+	requests. Writes through the ORM delete the cached row, other writes are
+	seen after at most ttl seconds.
+	"""
+	def __init__(self, model, backend, ttl):
+		self.model = model
+		self.backend = backend
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+
+	def _key(self, pk):
+		return '%s:%s' % (self.model.__table__, pk)
+
+	def get(self, pk):
+		d = self.backend.get(self._key(pk))
+		if d is None:
+			self.misses = self.misses + 1
+			return None
+		self.hits = self.hits + 1
+		return self.model._from_row(d)
+
+	def get_many(self, pks):
+		keys = dict([(self._key(pk), pk) for pk in pks])
+		found = self.backend.get_many(keys.keys())
+		self.hits = self.hits + len(found)
+		self.misses = self.misses + len(keys) - len(found)
+		return dict([(keys[k], self.model._from_row(d)) for k, d in found.iteritems()])
+
+	def put(self, objs):
+		# only complete rows are cached, and never rows read inside a transaction,
+		# because the transaction may roll back:
+		if db.in_transaction():
+			return
+		pk = self.model.__primary_key__.name
+		for obj in objs:
+			if not '_deferred' in obj.__dict__:
+				self.backend.set(self._key(obj[pk]), dict([(k, obj[k]) for k in self.model.__fields__ if k in obj]), self.ttl)
+
+	def delete(self, pk):
+		self.backend.delete(self._key(pk))
+
+	def stats(self):
+		total = self.hits + self.misses
+		return dict(table=self.model.__table__, ttl=self.ttl, hits=self.hits, misses=self.misses, hit_ratio=float(self.hits) / total if total else 0.0)
+
+_cache_backend = LRUCache
+_caches = {}
+_caches_lock = threading.Lock()
+
+def set_cache_backend(factory):
+	"""
+	Set the backend of model caches: factory(size) returns the backend of one
+	model, the default is LRUCache. Return the same object for every model to
+	share one store, e.g. set_cache_backend(lambda size: memcache_client).
+	"""
+	global _cache_backend
+	with _caches_lock:
+		_cache_backend = factory
+		_caches.clear()
+
+def _model_cache(cls):
+	# return the cache of a model with __cache__ = dict(ttl=..., size=...), or None:
+	if not cls.__cache__:
+		return None
+	c = _caches.get(cls.__table__)
+	if c is None:
+		with _caches_lock:
+			c = _caches.get(cls.__table__)
+			if c is None:
+				conf = cls.__cache__
+				c = _caches[cls.__table__] = _ModelCache(cls, _cache_backend(conf.get('size', 1000)), conf.get('ttl', 60))
+	return c
+
+def cache_stats():
+	"""
+	Return hits, misses and hit ratio of each model cache.
+	"""
+	return [c.stats() for c in _caches.values()]
+
+def _gen_sql(table_name, mappings, indexes=()):
 	# 生成数据库表结构？
 	pk = None
 	sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
@@ -126,7 +356,7 @@ def _gen_sql(table_name, mappings):
 		# sorted中的是一个匿名函数lambda？？意义何在？？这是sorted函数的参数cmp，用于调整排序逻辑。
 		# 在对mappings.values()进行排序时，按照每个值的._order的顺序排序。
 		if not hasattr(f, 'ddl'):
-			raise StandardError('no ddl in field "%s".' % n)
+			raise StandardError('no ddl in field "%s".' % f.name)
 		ddl = f.ddl
 		nullable = f.nullable
 		if f.primary_key:
@@ -134,7 +364,27 @@ def _gen_sql(table_name, mappings):
 		sql.append(nullable and ' `%s` %s,' % (f.name, ddl) or ' `%s` %s not null,' % (f.name, ddl))
 	sql.append(' primary key(`%s`)' % pk)
 	sql.append(');')
-	return '\n',join(sql)
+	# indexes as separate statements, which MySQL and SQLite both accept:
+	for name, cols, unique in indexes:
+		sql.append('create %sindex `%s` on `%s` (%s);' % ('unique ' if unique else '', name, table_name, ','.join(['`%s`' % mappings[k].name for k in cols])))
+	return '\n'.join(sql)
+
+def _make_from_row(cls):
+	# hydration function bound to one model class, with the lookups done once.
+	# Model.__init__ only calls dict.__init__, so it is skipped:
+	new = cls.__new__
+	update = dict.update
+	def _from_row(row, deferred=None):
+		# fill the model straight from the shared column names of db.Row, without an intermediate dict:
+		obj = new(cls)
+		update(obj, row.iteritems())
+		# loaded objects track changed fields, see Model.update():
+		obj.__dict__['_changed'] = set()
+		if deferred:
+			# stored in the instance __dict__, not as a dict item:
+			obj.__dict__['_deferred'] = set(deferred)
+		return obj
+	return _from_row
 
 class ModelMetaclass(type):
 	"""
@@ -155,8 +405,12 @@ class ModelMetaclass(type):
 
 		logging.info('Scan ORMapping %s...' % name)
 		mappings = dict()
+		relations = dict()
 		primary_key = None
 		for k, v in attrs.iteritems():
+			if isinstance(v, _Relation):
+				v.name = k
+				relations[k] = v
 			if isinstance(v, Field):
 				if not v.name:
 					v.name = k
@@ -176,17 +430,231 @@ class ModelMetaclass(type):
 		# check exist of primary key:
 		if not primary_key:
 			raise TypeError('Primary key not defines in class: %s' % name)
-		for k in mappings.iterkeys():
+		for k in mappings.keys() + relations.keys():
 			attrs.pop(k)
 		if not '__table__' in attrs:
 			attrs['__table__'] = name.lower()
 		attrs['__mappings__'] = mappings
 		attrs['__primary_key__'] = primary_key
-		attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings)
+		attrs['__relations__'] = relations
+		attrs['__deferred__'] = frozenset([k for k, v in mappings.iteritems() if v.deferred and not v.primary_key])
+		# indexes as (name, field names, unique), from fields with index=True or
+		# unique=True and from __indexes__, a list of tuples of field names.
+		# SQLite index names are global, so they include the table name:
+		indexes = []
+		for k, v in sorted(mappings.iteritems(), key=lambda kv: kv[1]._order):
+			if (v.index or v.unique) and not v.primary_key:
+				indexes.append(('idx_%s_%s' % (attrs['__table__'], v.name), (k, ), v.unique))
+		for cols in attrs.get('__indexes__', ()):
+			unknown = [k for k in cols if not k in mappings]
+			if unknown:
+				raise TypeError('Unknown fields in __indexes__ of class %s: %s' % (name, ','.join(unknown)))
+			indexes.append(('idx_%s_%s' % (attrs['__table__'], '_'.join([mappings[k].name for k in cols])), tuple(cols), False))
+		attrs['__indexes__'] = tuple(indexes)
+		attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings, attrs['__indexes__'])
+		# precompile the SQL used per object:
+		table = attrs['__table__']
+		pk = primary_key.name
+		fields = sorted(mappings.iteritems(), key=lambda kv: kv[1]._order)
+		insertable = [(k, v) for k, v in fields if v.insertable]
+		attrs['__fields__'] = tuple([k for k, v in fields])
+		attrs['__insertable__'] = tuple(insertable)
+		attrs['__updatable__'] = tuple([(k, v) for k, v in fields if v.updatable])
+		attrs['__select_sql__'] = 'select %s from `%s`' % (','.join(['`%s`' % v.name for k, v in fields if not k in attrs['__deferred__']]) if attrs['__deferred__'] else '*', table)
+		attrs['__get_sql__'] = 'select * from `%s` where `%s`=?' % (table, pk)
+		attrs['__insert_sql__'] = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % v.name for k, v in insertable]), ','.join(['?' for kv in insertable]))
+		attrs['__delete_sql__'] = 'delete from `%s` where `%s`=?' % (table, pk)
+		attrs['__count_sql__'] = 'select count(`%s`) from `%s`' % (pk, table)
+		# update SQL by tuple of updated fields:
+		attrs['__update_sqls__'] = {}
+		# Query SQL by shape:
+		attrs['__query_sqls__'] = {}
 		for trigger in _triggers:
 			if not trigger in attrs:
 				attrs[trigger] = None
-		return type.__new__(cls, name, bases, attrs)
+		new_cls = type.__new__(cls, name, bases, attrs)
+		new_cls._from_row = staticmethod(_make_from_row(new_cls))
+		# relations find their model by class name:
+		cls.subclasses[name] = new_cls
+		return new_cls
+
+class Query(object):
+	"""
+	Lazy and chainable query of a model, started by Model.query:
+
+	Blog.query.filter(user_id=uid).order_by('-create_at').limit(10)
+
+	Each call returns a new query, and no SQL runs until the query is iterated
+	or all(), first(), count(), exists(), iterator() or values() is called.
+	The SQL is compiled once per shape of query and cached on the model.
+	"""
+
+	# filter(name__op=value):
+	_OPS = {'eq': '=', 'ne': '<>', 'lt': '<', 'lte': '<=', 'gt': '>', 'gte': '>=', 'in': 'in'}
+
+	def __init__(self, model):
+		self._model = model
+		# tuple of (name, op, value):
+		self._filters = ()
+		# tuple of (sql, args) added by where():
+		self._wheres = ()
+		# tuple of (name, desc):
+		self._order = ()
+		self._limit = None
+		self._offset = 0
+		self._only = None
+		self._defer = None
+		self._prefetch = ()
+
+	def _clone(self, **kw):
+		q = Query.__new__(Query)
+		q.__dict__.update(self.__dict__)
+		for k, v in kw.iteritems():
+			setattr(q, '_' + k, v)
+		return q
+
+	def _check(self, names):
+		unknown = [k for k in names if not k in self._model.__mappings__]
+		if unknown:
+			raise AttributeError('Unknown fields of %s: %s' % (self._model.__name__, ','.join(unknown)))
+
+	def filter(self, **kw):
+		"""
+		Add conditions joined by 'and', e.g. filter(user_id=uid, create_at__lt=t).
+		Ops are eq (default), ne, lt, lte, gt, gte and in.
+		"""
+		L = []
+		for k, v in sorted(kw.iteritems()):
+			name, op = k.split('__', 1) if '__' in k else (k, 'eq')
+			if not op in self._OPS:
+				raise AttributeError('Unknown op: %s' % k)
+			self._check([name])
+			L.append((name, op, tuple(v) if op=='in' else v))
+		return self._clone(filters=self._filters + tuple(L))
+
+	def where(self, sql, *args):
+		"""
+		Add a raw condition, e.g. where('create_at>? or admin=?', t, True).
+		"""
+		return self._clone(wheres=self._wheres + ((sql, args), ))
+
+	def order_by(self, *names):
+		"""
+		Order by fields, a leading '-' means desc, e.g. order_by('-create_at', 'id').
+		"""
+		L = tuple([(k[1:], True) if k.startswith('-') else (k, False) for k in names])
+		self._check([k for k, desc in L])
+		return self._clone(order=L)
+
+	def limit(self, limit, offset=0):
+		return self._clone(limit=limit, offset=offset)
+
+	def only(self, *names):
+		return self._clone(only=names, defer=None)
+
+	def defer(self, *names):
+		return self._clone(defer=names, only=None)
+
+	def prefetch(self, *names):
+		return self._clone(prefetch=self._prefetch + names)
+
+	def _compile(self, kind, names=None):
+		# return (sql, deferred, args), the sql is cached by the shape of this query:
+		model = self._model
+		filters = tuple([(k, op, len(v) if op=='in' else None) for k, op, v in self._filters])
+		shape = (kind, names, self._only, self._defer, filters, tuple([sql for sql, a in self._wheres]), self._order, self._limit is not None)
+		args = []
+		for k, op, v in self._filters:
+			if op=='in':
+				args.extend(v)
+			else:
+				args.append(v)
+		for sql, a in self._wheres:
+			args.extend(a)
+		if kind in ('select', 'values', 'count') and self._limit is not None:
+			args.extend([self._offset, self._limit])
+		cached = model.__query_sqls__.get(shape)
+		if cached is not None:
+			return cached[0], cached[1], args
+		deferred = ()
+		pk = model.__primary_key__.name
+		if kind=='select':
+			kw = dict(only=self._only) if self._only is not None else dict(defer=self._defer) if self._defer is not None else {}
+			select, deferred = model._projection(kw)
+		elif kind=='values':
+			select = 'select %s from `%s`' % (','.join(['`%s`' % model.__mappings__[k].name for k in names]), model.__table__)
+		else:
+			select = 'select `%s` from `%s`' % (pk, model.__table__)
+		L = [select]
+		conds = []
+		for k, op, n in filters:
+			col = model.__mappings__[k].name
+			if op=='in':
+				conds.append('`%s` in (%s)' % (col, ','.join(['?'] * n)) if n else '1=0')
+			else:
+				conds.append('`%s`%s?' % (col, self._OPS[op]))
+		conds.extend(['(%s)' % sql for sql, a in self._wheres])
+		if conds:
+			L.append('where %s' % ' and '.join(conds))
+		if kind=='exists':
+			L.append('limit 1')
+		else:
+			if self._order and kind!='count':
+				L.append('order by %s' % ','.join(['`%s`%s' % (model.__mappings__[k].name, ' desc' if desc else '') for k, desc in self._order]))
+			if self._limit is not None:
+				L.append('limit ?,?')
+		sql = ' '.join(L)
+		if kind=='count':
+			sql = 'select count(*) from (%s) as t' % sql if self._limit is not None else sql.replace('select `%s`' % pk, 'select count(`%s`)' % pk, 1)
+		if len(model.__query_sqls__) < 256:
+			model.__query_sqls__[shape] = (sql, deferred)
+		return sql, deferred, args
+
+	def all(self):
+		model = self._model
+		sql, deferred, args = self._compile('select')
+		L = [model._from_row(d, deferred) for d in db.select(sql, *args)]
+		return model.prefetch(model._remember(L), *self._prefetch)
+
+	def __iter__(self):
+		return iter(self.all())
+
+	def first(self):
+		L = self._clone(limit=1).all()
+		return L[0] if L else None
+
+	def count(self):
+		sql, deferred, args = self._compile('count')
+		return db.select_int(sql, *args)
+
+	def exists(self):
+		sql, deferred, args = self._compile('exists')
+		return db.select_one(sql, *args) is not None
+
+	def iterator(self, batch=1000):
+		"""
+		Yield objects one by one from an unbuffered cursor, see db.select_iter().
+		Relations are not prefetched, and objects are not put into the identity
+		map, so memory stays flat.
+		"""
+		model = self._model
+		sql, deferred, args = self._compile('select')
+		for d in db.select_iter(sql, *args, batch=batch):
+			yield model._from_row(d, deferred)
+
+	def values(self, *names):
+		"""
+		Return db.Row results of the named fields, without building model objects.
+		"""
+		names = names or self._model.__fields__
+		self._check(names)
+		sql, deferred, args = self._compile('values', names)
+		return db.select(sql, *args)
+
+class _QueryProperty(object):
+	# Model.query returns a new Query of the model class:
+	def __get__(self, obj, cls):
+		return Query(cls)
 
 class Model(dict):
 	"""
@@ -195,6 +663,10 @@ class Model(dict):
 
 	"""
 	__metaclass__ = ModelMetaclass
+
+	query = _QueryProperty()
+	# second level cache by primary key, e.g. __cache__ = dict(ttl=60, size=1000):
+	__cache__ = None
 	# 定义这个类的属性的目的是？用于读取具体的映射关系？
 
 	def __init__(self, **kw):
@@ -204,95 +676,408 @@ class Model(dict):
 		try:
 			return self[key]
 		except KeyError:
+			if key in self.__dict__.get('_deferred', ()):
+				self._load_deferred()
+				return self[key]
+			if key in self.__relations__:
+				related = self.__dict__.get('_related', {})
+				if not key in related:
+					self.__relations__[key].load([self])
+				return self.__dict__['_related'][key]
 			raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
 
 	def __setattr__(self, key, value):
 		self[key] = value
+		deferred = self.__dict__.get('_deferred')
+		if deferred:
+			deferred.discard(key)
+
+	def __setitem__(self, key, value):
+		changed = self.__dict__.get('_changed')
+		if changed is not None and not (key in self and self[key]==value):
+			changed.add(key)
+		dict.__setitem__(self, key, value)
+
+	def _set_related(self, name, value):
+		# related objects are kept out of the dict items, so they are never saved or serialized:
+		self.__dict__.setdefault('_related', {})[name] = value
+
+	def _mark_clean(self):
+		# the object now matches its row, track changes from here:
+		self.__dict__['_changed'] = set()
+
+	def _load_deferred(self):
+		# load all deferred fields of this object that are still missing with one query:
+		names = [k for k in self.__dict__.pop('_deferred', ()) if not k in self]
+		if not names:
+			return
+		pk = self.__primary_key__.name
+		d = db.select_one('select %s from `%s` where `%s`=?' % (','.join(['`%s`' % k for k in names]), self.__table__, pk), self[pk])
+		if d:
+			dict.update(self, d.iteritems())
+
+	@classmethod
+	def _projection(cls, kw):
+		"""
+		Pop only/defer from kw and return ('select ... from table', deferred field names).
+
+		only: names of the fields to load, the primary key is always loaded.
+		defer: names of the fields to leave out, instead of the fields declared
+			with deferred=True. Pass defer=() to load every field.
+		"""
+		only = kw.pop('only', None)
+		defer = kw.pop('defer', None)
+		pk = cls.__primary_key__.name
+		if only is not None:
+			deferred = frozenset([k for k in cls.__mappings__ if k!=pk and not k in only])
+			unknown = set(only) - set(cls.__mappings__)
+		elif defer is not None:
+			deferred = frozenset(defer) - set([pk])
+			unknown = deferred - set(cls.__mappings__)
+		else:
+			return cls.__select_sql__, cls.__deferred__
+		if unknown:
+			raise AttributeError('Unknown fields of %s: %s' % (cls.__name__, ','.join(unknown)))
+		if not deferred:
+			return 'select * from `%s`' % cls.__table__, deferred
+		cols = ','.join(['`%s`' % cls.__mappings__[k].name for k in cls.__fields__ if not k in deferred])
+		return 'select %s from `%s`' % (cols, cls.__table__), deferred
+
+	@classmethod
+	def _update_sql(cls, keys):
+		sql = cls.__update_sqls__.get(keys)
+		if sql is None:
+			sql = 'update `%s` set %s where `%s`=?' % (cls.__table__, ','.join(['`%s`=?' % cls.__mappings__[k].name for k in keys]), cls.__primary_key__.name)
+			if len(cls.__update_sqls__) < 256:
+				cls.__update_sqls__[keys] = sql
+		return sql
+
+	@classmethod
+	def _load_in(cls, key, values, order_by=None, full=False):
+		# load objects whose field key is in values, with one query per _IN_CHUNK_SIZE values.
+		# full=True loads the deferred fields too:
+		values = list(values)
+		col = cls.__mappings__[key].name
+		order = ' order by %s' % order_by if order_by else ''
+		select, deferred = ('select * from `%s`' % cls.__table__, ()) if full else (cls.__select_sql__, cls.__deferred__)
+		L = []
+		for i in xrange(0, len(values), _IN_CHUNK_SIZE):
+			chunk = values[i:i + _IN_CHUNK_SIZE]
+			rows = db.select('%s where `%s` in (%s)%s' % (select, col, ','.join(['?'] * len(chunk)), order), *chunk)
+			L.extend([cls._from_row(d, deferred) for d in rows])
+		return cls._remember(L)
+
+	@classmethod
+	def prefetch(cls, objs, *names):
+		"""
+		Load the named relations of all objects, one query per relation and
+		not one per object. The find_xxx() methods take prefetch=(...) too.
+
+		comments = Comment.find_by('where blog_id=?', blog_id, prefetch=('user',))
+		"""
+		for name in names:
+			relation = cls.__relations__.get(name)
+			if relation is None:
+				raise AttributeError('Unknown relation of %s: %s' % (cls.__name__, name))
+			relation.load(objs)
+		return objs
+
+	@classmethod
+	def _remember(cls, objs):
+		# put loaded objects into the identity map, the latest load wins:
+		m = _identity_map()
+		if m is not None:
+			pk = cls.__primary_key__.name
+			for obj in objs:
+				m[(cls.__table__, obj[pk])] = obj
+		return objs
 
 	@classmethod
 	# classmethod装饰器可以使该方法不用实例化，直接调用。
 	# 可以直接通过类方法实现主键查找，不需要实例化
 	def get(cls, pk):
 		"""
-		Get by primary key.
+		Get by primary key. Inside a db connection context, an object already
+		loaded or saved in the same context is returned without a query, then
+		the model cache is tried if __cache__ is set.
+		"""
+		# the identity map is keyed by the stored type, e.g. int ids:
+		pk = cls.__primary_key__.convert(pk)
+		m = _identity_map()
+		if m is not None:
+			obj = m.get((cls.__table__, pk))
+			if obj is not None:
+				return obj
+		c = _model_cache(cls)
+		if c is not None:
+			obj = c.get(pk)
+			if obj is not None:
+				return cls._remember([obj])[0]
+		if c is None:
+			d = db.select_one(cls.__get_sql__, pk)
+		else:
+			# rows that fill the model cache are read from the primary, see db.primary():
+			with db.primary():
+				d = db.select_one(cls.__get_sql__, pk)
+		if not d:
+			return None
+		obj = cls._from_row(d)
+		if c is not None:
+			c.put([obj])
+		return cls._remember([obj])[0]
+
+	@classmethod
+	def get_many(cls, pks):
+		"""
+		Get by a list of primary keys and return a dict of pk => object, keys
+		not found are left out. Duplicate keys are queried once, objects in the
+		identity map or in the model cache are not queried, and the rest are
+		queried with one 'in (...)' query per 500 keys. Models with __cache__
+		load complete rows, deferred fields included, to fill the cache.
 		"""
-		d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-		return cls(**d) if d else None
+		found = {}
+		missing = set([cls.__primary_key__.convert(pk) for pk in pks])
+		m = _identity_map()
+		if m is not None:
+			for pk in list(missing):
+				obj = m.get((cls.__table__, pk))
+				if obj is not None:
+					found[pk] = obj
+					missing.discard(pk)
+		c = _model_cache(cls)
+		if c is not None and missing:
+			cached = c.get_many(missing)
+			cls._remember(cached.values())
+			found.update(cached)
+			missing.difference_update(cached)
+		key = cls.__primary_key__.name
+		if c is None:
+			loaded = cls._load_in(key, missing)
+		else:
+			with db.primary():
+				loaded = cls._load_in(key, missing, full=True)
+			c.put(loaded)
+		for obj in loaded:
+			found[obj[key]] = obj
+		return found
 
 	@classmethod
-	def find_first(cls, where, *args):
+	def find_first(cls, where, *args, **kw):
 		"""
 		Find by where clause and return one result.
+
+		Fields declared with deferred=True are not loaded until accessed, and
+		keyword arguments only=(...) or defer=(...) choose the loaded fields,
+		the same for all find_xxx() methods.
 		"""
-		d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
-		return cls(**d) if d else None
+		prefetch = kw.pop('prefetch', ())
+		select, deferred = cls._projection(kw)
+		d = db.select_one('%s %s' % (select, where), *args)
+		if not d:
+			return None
+		return cls.prefetch(cls._remember([cls._from_row(d, deferred)]), *prefetch)[0]
 
 	@classmethod
-	def find_all(cls, *args):
+	def find_all(cls, *args, **kw):
 		"""
 		Find all and return list.
 		"""
-		L = db.select('select * from `%s`' % cls.__table__)
-		return [cls(**d) for d in L]
+		prefetch = kw.pop('prefetch', ())
+		select, deferred = cls._projection(kw)
+		L = db.select(select)
+		return cls.prefetch(cls._remember([cls._from_row(d, deferred) for d in L]), *prefetch)
 
 	@classmethod
-	def find_by(cls, where, *args):
+	def find_by(cls, where, *args, **kw):
 		"""
 		Find by where clause and return list.
+
+		Blog.find_by('order by create_at desc limit ?,?', 0, 10, only=('name', 'summary'))
 		"""
-		L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-		return [cls(**d) for d in L]
+		prefetch = kw.pop('prefetch', ())
+		select, deferred = cls._projection(kw)
+		L = db.select('%s %s' % (select, where), *args)
+		return cls.prefetch(cls._remember([cls._from_row(d, deferred) for d in L]), *prefetch)
 
 	@classmethod
-	def count_all(cls):
+	def iter_by(cls, where, *args, **kw):
+		"""
+		Find by where clause and yield results one by one, see db.select_iter().
+		Objects are not put into the identity map, so memory stays flat.
+		"""
+		select, deferred = cls._projection(kw)
+		for d in db.select_iter('%s %s' % (select, where), *args, **kw):
+			yield cls._from_row(d, deferred)
+
+	@classmethod
+	def count_all(cls, max_age=None):
 		"""
 		Find by 'select count(pk) from table' and return integer.
+
+		With max_age, a count at most max_age seconds old is returned without
+		a query. It follows the ORM inserts and deletes of this process since.
 		"""
-		return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
+		if max_age is None:
+			return db.select_int(cls.__count_sql__)
+		c = _counts.get(cls.__table__)
+		now = time.time()
+		if c is None or c[1] + max_age < now:
+			c = _counts[cls.__table__] = [db.select_int(cls.__count_sql__), now]
+		return c[0]
 
 	@classmethod
 	def count_by(cls, where, *args):
 		"""
 		Find by 'select count(pk) from table where ...' and return int.
 		"""
-		return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
+		return db.select_int('%s %s' % (cls.__count_sql__, where), *args)
 
 	def update(self):
+		"""
+		Update the row of this object. An object loaded from db (or already
+		inserted or updated) writes only the fields changed since, and runs no
+		statement at all if nothing changed. Other objects write all fields.
+		"""
+		changed = self.__dict__.get('_changed')
+		if changed is not None and not changed:
+			return self
 		self.pre_update and self.pre_update()
-		L = []
+		keys = []
 		args = []
-		for k, v in self.__mappings__.iteritems():
-			if v.updatable:
-				if hasattr(self, k):
-					arg = getattr(self, k)
-				else:
-					arg = v.default
-					setattr(self, k, arg)
-				L.append('`%s`=?' % k)
-				args.append(arg)
-		pk = self.__primary_key__.name
-		args.append(getattr(self, pk))
-		db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+		if changed is None:
+			# fields still deferred were not loaded, so they are not changed:
+			deferred = self.__dict__.get('_deferred', ())
+			for k, v in self.__updatable__:
+				if not k in deferred:
+					if not k in self:
+						self[k] = v.default
+					keys.append(k)
+					args.append(self[k])
+		else:
+			for k, v in self.__updatable__:
+				if k in changed:
+					keys.append(k)
+					args.append(self[k])
+		if keys:
+			args.append(self[self.__primary_key__.name])
+			self._write(self.post_update, self._update_sql(tuple(keys)), *args)
+			self._uncache()
+		self._mark_clean()
+		self._remember([self])
 		return self
 
 	def delete(self):
 		self.pre_delete and self.pre_delete()
-		pk = self.__primary_key__.name
-		args = (getattr(self, pk), )
-		db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+		pk = self[self.__primary_key__.name]
+		self._write(self.post_delete, self.__delete_sql__, pk)
+		self._uncache()
+		_count_changed(self.__class__, -1)
+		m = _identity_map()
+		if m is not None:
+			m.pop((self.__table__, pk), None)
+
+	def _write(self, hook, sql, *args):
+		# run the statement and the post_xxx trigger in one transaction:
+		if hook is None:
+			return db.update(sql, *args)
+		with db.transaction():
+			db.update(sql, *args)
+			hook()
+
+	def _uncache(self):
+		self.uncache(self[self.__primary_key__.name])
+
+	@classmethod
+	def uncache(cls, pk):
+		"""
+		Drop the row of pk from the model cache, after a write outside the ORM.
+		Inside a transaction it is dropped again when the transaction ends,
+		since other requests may cache the old row until the commit.
+		"""
+		c = _model_cache(cls)
+		if c is not None:
+			c.delete(pk)
+			if db.in_transaction():
+				db.after_transaction(lambda: c.delete(pk))
+
+	@classmethod
+	def increase(cls, pk, **deltas):
+		"""
+		Add deltas to counter fields of one row in place, without reading it
+		first, so concurrent increases are not lost:
+
+		Blog.increase(blog_id, comment_count=1)
+		"""
+		pk = cls.__primary_key__.convert(pk)
+		keys = tuple(sorted(deltas))
+		sql = cls.__update_sqls__.get(('+', ) + keys)
+		if sql is None:
+			sql = cls.__update_sqls__[('+', ) + keys] = 'update `%s` set %s where `%s`=?' % (cls.__table__, ','.join(['`%s`=`%s`+?' % (cls.__mappings__[k].name, cls.__mappings__[k].name) for k in keys]), cls.__primary_key__.name)
+		db.update(sql, *([deltas[k] for k in keys] + [pk]))
+		cls.uncache(pk)
+		# keep a loaded object up to date, without marking it changed:
+		m = _identity_map()
+		obj = m.get((cls.__table__, pk)) if m is not None else None
+		if obj is not None:
+			for k in keys:
+				if k in obj:
+					dict.__setitem__(obj, k, obj[k] + deltas[k])
+
+	def _insert_args(self):
+		# apply defaults and return args of __insert_sql__:
+		if '_deferred' in self.__dict__:
+			self._load_deferred()
+		args = []
+		for k, v in self.__insertable__:
+			if not k in self:
+				self[k] = v.default
+			args.append(self[k])
+		return args
 
 	def insert(self):
 		# 实例方法，实例化后调用方法进行处理。
 		self.pre_insert and self.pre_insert()
-		params = {}
-		for k, v in self.__mappings__.iteritems():
-			if v.insertable:
-				if not hasattr(self, k):
-					setattr(self, k, v.default)
-				params[v.name] = getattr(self, k)
-		db.insert('%s' % self.__table__, **params)
+		self._write(self.post_insert, self.__insert_sql__, *self._insert_args())
+		_count_changed(self.__class__, 1)
+		self._mark_clean()
+		self._remember([self])
 		return self
 
+	@classmethod
+	def insert_all(cls, objs, chunk_size=500, on_duplicate=None):
+		"""
+		Insert many objects with multi-row insert SQL, see db.insert_many(). With
+		on_duplicate='update' only updatable fields of existing rows change.
+		Defaults and pre_insert triggers are applied to each object first, and
+		post_insert triggers run after, in the same transaction. Models with
+		post_insert cannot use on_duplicate: which rows were really inserted is
+		not known, so the triggers would run for skipped or overwritten rows.
+		"""
+		if on_duplicate is not None and cls.post_insert is not None:
+			raise ValueError('%s has post_insert, on_duplicate is not supported.' % cls.__name__)
+		names = [v.name for k, v in cls.__insertable__]
+		# an upsert overwrites only updatable fields, e.g. not create_at:
+		update = [v.name for k, v in cls.__updatable__ if v.name in names]
+		rows = []
+		for obj in objs:
+			obj.pre_insert and obj.pre_insert()
+			rows.append(dict(zip(names, obj._insert_args())))
+		if cls.post_insert is None:
+			db.insert_many(cls.__table__, rows, chunk_size, on_duplicate, cls.__primary_key__.name, update)
+		else:
+			with db.transaction():
+				db.insert_many(cls.__table__, rows, chunk_size, on_duplicate, cls.__primary_key__.name, update)
+				for obj in objs:
+					obj.post_insert()
+		for obj in objs:
+			obj._mark_clean()
+			if on_duplicate=='update':
+				obj._uncache()
+		if on_duplicate is None:
+			_count_changed(cls, len(objs))
+			cls._remember(objs)
+		return objs
+
 if __name__=='__main__':
 	logging.basicConfig(level=logging.DEBUG)
 	db.create_engine('www-data', 'www-data', 'test')
@@ -1152,6 +1152,7 @@ class WSGIApplication(object):
 		self._document_root = document_root
 
 		self.__interceptors = []
+		self.__request_contexts = []
 		self._template_engine = None
 
 		self._get_static = {}
@@ -1233,9 +1234,34 @@ class WSGIApplication(object):
 		self.__interceptors.append(func)
 		logging.info('Add interceptor: %s' % str(func))
 
-	def run(self, port=9000, host='127.0.0.1'):
-		from wsgiref.simple_server import make_server
+	def add_request_context(self, func):
+		"""
+		Add a context factory wrapping every request, e.g. db.connection.
+		The context is entered before the interceptors run and exited after
+		the response body is rendered.
+		"""
+		self._check_not_running()
+		self.__request_contexts.append(func)
+		logging.info('Add request context: %s' % str(func))
+
+	def run(self, port=9000, host='127.0.0.1', server='wsgiref'):
+		"""
+		Run a debug server.
+
+		server='gevent' serves every request in its own greenlet, so one process
+		handles many concurrent requests waiting on the database. It requires
+		gevent.monkey.patch_all() before transwarp is imported, which makes the
+		thread local ctx and db context greenlet local and sockets cooperative.
+		"""
 		logging.info('application (%s) will start at %s:%s...' % (self._document_root, host, port))
+		if server=='gevent':
+			from gevent import monkey
+			from gevent.pywsgi import WSGIServer
+			if not monkey.is_module_patched('threading') or not monkey.is_module_patched('socket'):
+				raise RuntimeError('Call gevent.monkey.patch_all() before importing transwarp.')
+			WSGIServer((host, port), self.get_wsgi_application(debug=True)).serve_forever()
+			return
+		from wsgiref.simple_server import make_server
 		server = make_server(host, port, self.get_wsgi_application(debug=True))
 		server.serve_forever()
 
@@ -1272,12 +1298,18 @@ class WSGIApplication(object):
 			raise badrequest()
 
 		fn_exec = _build_interceptor_chain(fn_route, *self.__interceptors)
+		request_contexts = list(self.__request_contexts)
 
 		def wsgi(env, start_response):
 			ctx.application = _application
 			ctx.request = Request(env)
 			response = ctx.response = Response()
+			contexts = []
 			try:
+				for fn in request_contexts:
+					c = fn()
+					c.__enter__()
+					contexts.append(c)
 				r = fn_exec()
 				if isinstance(r, Template):
 					r = self._template_engine(r.template_name, r.model)
@@ -1310,6 +1342,11 @@ class WSGIApplication(object):
 					stacks.replace('<', '&lt;').replace('>', '&gt;'),
 					'</pre></div></body></html>']
 			finally:
+				while contexts:
+					try:
+						contexts.pop().__exit__(None, None, None)
+					except Exception, e:
+						logging.exception(e)
 				del ctx.application
 				del ctx.request
 				del ctx.response
@@ -9,9 +9,10 @@ import os, re, time, base64, hashlib
 
 import markdown2
 
+from transwarp import db
 from transwarp.web import get, view, post, ctx, interceptor, seeother, notfound
 
-from apis import api, Page, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
+from apis import api, Page, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError, encode_cursor, decode_cursor
 
 from models import User, Blog, Comment
 
@@ -20,6 +21,9 @@ from config import configs
 _COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
 
+# seconds a count of the list APIs may be stale:
+_COUNT_MAX_AGE = 60
+
 def _get_page_index():
 	page_index = 1
 	try:
@@ -28,10 +32,25 @@ def _get_page_index():
 		pass
 	return page_index
 
+def _get_by_cursor(q, cursor, page_size=10):
+	# keyset pagination, newest first: the cursor is the (create_at, id) of the
+	# last item seen, so a page costs the same at any depth. Return (items, next_cursor):
+	if cursor:
+		values = decode_cursor(cursor)
+		if len(values)!=2:
+			raise APIValueError('cursor', 'invalid cursor.')
+		t, id = values
+		q = q.where('`create_at`<? or (`create_at`=? and `id`<?)', t, t, id)
+	L = q.order_by('-create_at', '-id').limit(page_size + 1).all()
+	return L[:page_size], _next_cursor(L[:page_size], len(L) > page_size)
+
+def _next_cursor(items, has_next):
+	return encode_cursor(items[-1].create_at, items[-1].id) if has_next and items else None
+
 def make_signed_cookie(id, password, max_age):
 	# build cookie string by: id-expires-md5
 	expires = str(int(time.time() + (max_age or 86400)))
-	L = [id, expires, hashlib.md5('%s-%s-%s-%s' % (id, password, expires, _COOKIE_KEY)).hexdigest()]
+	L = [str(id), expires, hashlib.md5('%s-%s-%s-%s' % (id, password, expires, _COOKIE_KEY)).hexdigest()]
 	return '-'.join(L)
 
 def parse_signed_cookie(cookie_str):
@@ -42,7 +61,7 @@ def parse_signed_cookie(cookie_str):
 		id, expires, md5 = L
 		if int(expires) < time.time():
 			return None
-		user = User.get(id)
+		user = User.get(db.to_id(id))
 		if user is None:
 			return None
 		if md5 != hashlib.md5('%s-%s-%s-%s' % (id, user.password, expires, _COOKIE_KEY)).hexdigest():
@@ -84,16 +103,18 @@ def manage_interceptor(next):
 		return next()
 	raise seeother('/signin')
 
-def _get_blogs_by_page():
-	total = Blog.count_all()
-	page = Page(total, _get_page_index())
-	blogs = Blog.find_by('order by create_at desc limit ?,?', page.offset, page.limit)
-	return blogs, page
+def _get_blogs_by_page(defer=None, count=True):
+	# Blog.content is deferred by default, defer=() loads it.
+	# count=False only finds out if there is a next page, without counting:
+	page = Page(Blog.count_all(max_age=_COUNT_MAX_AGE) if count else None, _get_page_index())
+	q = Blog.query.order_by('-create_at', '-id').limit(page.limit, page.offset)
+	blogs = (q if defer is None else q.defer(*defer)).all()
+	return blogs if count else page.trim(blogs), page
 
 @view('blogs.html')
 @get('/')
 def index():
-	blogs, page = _get_blogs_by_page()
+	blogs, page = _get_blogs_by_page(count=False)
 	# 查找登陆用户：
 	# user = User.find_first('where email=?', 'admin@example.com')
 	return dict(page=page, blogs=blogs, user=ctx.request.user)
@@ -102,11 +123,11 @@ def index():
 @get('/blog/:blog_id')
 # 装饰器get是web.py中定义的，函数中的get是orm.py中的类Model中定义的
 def blog(blog_id):
-    blog = Blog.get(blog_id)
+    blog = Blog.get(db.to_id(blog_id))
     if blog is None:
         raise notfound()
     blog.html_content = markdown2.markdown(blog.content)
-    comments = Comment.find_by('where blog_id=? order by create_at desc limit 1000', blog_id)
+    comments = Comment.query.filter(blog_id=blog.id).order_by('-create_at').limit(1000).prefetch('user').all()
     return dict(blog=blog, comments=comments, user=ctx.request.user)
     """
 	@classmethod
@@ -177,11 +198,13 @@ def register_user():
 def register():
 	return dict()
 
-def _get_blogs_by_page():
-	total = Blog.count_all()
-	page = Page(total, _get_page_index())
-	blogs = Blog.find_by('order by create_at desc limit ?,?', page.offset, page.limit)
-	return blogs, page
+def _get_blogs_by_page(defer=None, count=True):
+	# Blog.content is deferred by default, defer=() loads it.
+	# count=False only finds out if there is a next page, without counting:
+	page = Page(Blog.count_all(max_age=_COUNT_MAX_AGE) if count else None, _get_page_index())
+	q = Blog.query.order_by('-create_at', '-id').limit(page.limit, page.offset)
+	blogs = (q if defer is None else q.defer(*defer)).all()
+	return blogs if count else page.trim(blogs), page
 
 @get('/manage/')
 def manage_index():
@@ -205,7 +228,7 @@ def manage_blogs_create():
 @view('manage_blog_edit.html')
 @get('/manage/blogs/edit/:blog_id')
 def manage_blogs_edit(blog_id):
-	blog = Blog.get(blog_id)
+	blog = Blog.get(db.to_id(blog_id))
 	if blog is None:
 		raise notfound()
 	return dict(id=blog_id, name=blog.name, summary=blog.summary, content=blog.content, action='/api/blogs/%s' % blog_id, redirect='/manage/blogs', user=ctx.request.user)
@@ -218,17 +241,24 @@ def manage_users():
 @api
 @get('/api/blogs')
 def api_get_blogs():
+	# ?cursor= (empty for the first page) pages by cursor, ?page= by page index:
 	format = ctx.request.get('format', '')
-	blogs, page = _get_blogs_by_page()
+	cursor = ctx.request.get('cursor')
+	if cursor is not None:
+		blogs, next_cursor = _get_by_cursor(Blog.query.defer() if format=='html' else Blog.query, cursor)
+		r = dict(blogs=blogs, next_cursor=next_cursor)
+	else:
+		blogs, page = _get_blogs_by_page(defer=()) if format=='html' else _get_blogs_by_page()
+		r = dict(blogs=blogs, page=page, next_cursor=_next_cursor(blogs, page.has_next))
 	if format=='html':
 		for blog in blogs:
 			blog.content = markdown2.markdown(blog.content)
-	return dict(blogs=blogs, page=page)
+	return r
 
 @api
 @get('/api/blogs/:blog_id')
 def api_get_blog(blog_id):
-	blog = Blog.get(blog_id)
+	blog = Blog.get(db.to_id(blog_id))
 	if blog:
 		return blog
 	raise APIResourceNotFoundError('Blog')
@@ -266,7 +296,7 @@ def api_update_blog(blog_id):
         raise APIValueError('summary', 'summary cannot be empty.')
     if not content:
         raise APIValueError('content', 'content cannot be empty.')
-    blog = Blog.get(blog_id)
+    blog = Blog.get(db.to_id(blog_id))
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     blog.name = name
@@ -279,11 +309,11 @@ def api_update_blog(blog_id):
 @post('/api/blogs/:blog_id/delete')
 def api_delete_blog(blog_id):
     check_admin()
-    blog = Blog.get(blog_id)
+    blog = Blog.get(db.to_id(blog_id))
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     blog.delete()
-    return dict(id=blog_id)
+    return dict(id=blog.id)
 
 @api
 @post('/api/blogs/:blog_id/comments')
@@ -291,13 +321,13 @@ def api_create_blog_comment(blog_id):
     user = ctx.request.user
     if user is None:
         raise APIPermissionError('Need signin.')
-    blog = Blog.get(blog_id)
+    blog = Blog.get(db.to_id(blog_id))
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     content = ctx.request.input(content='').content.strip()
     if not content:
         raise APIValueError('content')
-    c = Comment(blog_id=blog_id, user_id=user.id, user_name=user.name, user_image=user.image, content=content)
+    c = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content)
     c.insert()
     return dict(comment=c)
 
@@ -305,26 +335,36 @@ def api_create_blog_comment(blog_id):
 @post('/api/comments/:comment_id/delete')
 def api_delete_comment(comment_id):
     check_admin()
-    comment = Comment.get(comment_id)
+    comment = Comment.get(db.to_id(comment_id))
     if comment is None:
         raise APIResourceNotFoundError('Comment')
     comment.delete()
-    return dict(id=comment_id)
+    return dict(id=comment.id)
 
 @api
 @get('/api/comments')
 def api_get_comments():
-    total = Comment.count_all()
+    cursor = ctx.request.get('cursor')
+    if cursor is not None:
+        comments, next_cursor = _get_by_cursor(Comment.query, cursor)
+        return dict(comments=comments, next_cursor=next_cursor)
+    total = Comment.count_all(max_age=_COUNT_MAX_AGE)
     page = Page(total, _get_page_index())
-    comments = Comment.find_by('order by create_at desc limit ?,?', page.offset, page.limit)
-    return dict(comments=comments, page=page)
+    comments = Comment.query.order_by('-create_at', '-id').limit(page.limit, page.offset).all()
+    return dict(comments=comments, page=page, next_cursor=_next_cursor(comments, page.has_next))
 
 @api
 @get('/api/users')
 def api_get_users():
-    total = User.count_all()
-    page = Page(total, _get_page_index())
-    users = User.find_by('order by create_at desc limit ?,?', page.offset, page.limit)
+    cursor = ctx.request.get('cursor')
+    if cursor is not None:
+        users, next_cursor = _get_by_cursor(User.query, cursor)
+        r = dict(users=users, next_cursor=next_cursor)
+    else:
+        total = User.count_all(max_age=_COUNT_MAX_AGE)
+        page = Page(total, _get_page_index())
+        users = User.query.order_by('-create_at', '-id').limit(page.limit, page.offset).all()
+        r = dict(users=users, page=page, next_cursor=_next_cursor(users, page.has_next))
     for u in users:
         u.password = '******'
-    return dict(users=users, page=page)
\ No newline at end of file
+    return r
\ No newline at end of file
@@ -10,7 +10,13 @@ A WSGI application entry.
 
 import logging; logging.basicConfig(level=logging.INFO)
 
-import os, time
+import os, sys, time
+
+# python wsgiapp.py gevent: 协程方式运行，必须在导入transwarp之前patch：
+_GEVENT = __name__ == '__main__' and 'gevent' in sys.argv[1:]
+if _GEVENT:
+	from gevent import monkey; monkey.patch_all()
+
 from datetime import datetime
 
 from transwarp import db
@@ -21,6 +27,14 @@ from config import configs
 # init db:
 # 初始化数据库：
 db.create_engine(**configs.db)
+# 新记录的id格式：
+db.set_id_format(**configs.ids)
+# 只读从库，select按权重轮询分发：
+for replica in configs.db_replicas:
+	db.add_replica(**replica)
+# 缓存很少变化的表的查询结果，写入时自动失效：
+if configs.db_cache.tables:
+	db.enable_query_cache(**configs.db_cache)
 # 参数为config.py中的变量configs的db属性
 # config.py合并了config_default和config_override，导入config_default，尝试导入config_override，如果成功，进行merge。
 # configs变量最后进行了toDict的操作，为什么要进行这个操作？configs中的session的作用是？
@@ -57,6 +71,9 @@ template_engine.add_filter('datetime', datetime_filter)
 
 wsgi.template_engine = template_engine
 
+# 每个请求共用一个数据库连接上下文，只有真正执行SQL时才从连接池借出连接：
+wsgi.add_request_context(db.connection)
+
 # 加载带有@get／@post的URL处理函数：
 import urls
 
@@ -136,4 +153,4 @@ wsgi.add_module(urls)
 
 # 在9000端口上启动本地测试服务器：
 if __name__ == '__main__':
-	wsgi.run(9001, host='0.0.0.0')
\ No newline at end of file
+	wsgi.run(9001, host='0.0.0.0', server='gevent' if _GEVENT else 'wsgiref')
\ No newline at end of file